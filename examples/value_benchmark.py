@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Klaudisz Staniek.
+# See LICENSE for details.
+
+"""
+Micro-benchmark of the value ingest hot path (Value.update).
+The driver is not started - no controller connection is required.
+"""
+
+
+from has.manager.hc2.hc2driver import HC2Driver
+from has.manager.hc2.hc2nodes import HC2Device
+from has.manager.value import Value
+import timeit
+
+updates = 100000
+
+driver = HC2Driver("HC2-000001", "admin", "admin", "127.0.0.1", 80)
+node = HC2Device(driver.network_id, 1, driver)
+driver.nodes[1] = node
+
+value = Value(driver.network_id, 1, "value", "0", "")
+node.add_value(value)
+
+values = [ str(i % 100) for i in range(updates) ]
+
+def run():
+    for v in values:
+        value.update(v)
+    driver.notifications.clear()
+
+best = min( timeit.repeat( run, number=1, repeat=5 ) )
+print("Value.update: {0:.2f} us/call ({1} updates)".format( best / updates * 1e6, updates ) )
@@ -0,0 +1,65 @@
+# Copyright (c) Klaudisz Staniek.
+# See LICENSE for details.
+
+"""
+Driver state cache implementation
+
+"""
+
+import json
+import os
+from time import time
+
+import logging
+logger = logging.getLogger('manager')
+
+
+class StateCache(object):
+    """
+    Persistent snapshot of the driver state used for the warm start.
+    The state is the dictionary serialized to the JSON file. The file is replaced atomically,
+    so the crash during save leaves the previous snapshot intact.
+    """
+    version = 1
+
+    def __init__(self, filename):
+        """
+        Params:
+            filename    :    path of the cache file
+        """
+        self.filename = filename
+
+    def load(self, network_id):
+        """
+        Returns the state dictionary saved for the network or None if there is no valid snapshot
+        """
+        try:
+            with open( self.filename, 'r', encoding='utf-8' ) as f:
+                state = json.load( f )
+        except FileNotFoundError:
+            logger.info( "StateCache.load: No cache file {0}".format( self.filename ) )
+            return None
+        except ( OSError, ValueError ) as e:
+            logger.error( "StateCache.load: Can not read cache file {0}: {1}".format( self.filename, e ) )
+            return None
+
+        if state.get( 'version' ) != self.version or state.get( 'network_id' ) != network_id:
+            logger.error( "StateCache.load: Cache file {0} does not match network {1}".format( self.filename, network_id ) )
+            return None
+        return state
+
+    def save(self, network_id, state):
+        """
+        Write the state dictionary. Returns True if saved.
+        """
+        state = dict( state, version = self.version, network_id = network_id, saved = time() )
+        temp = self.filename + ".tmp"
+        try:
+            with open( temp, 'w', encoding='utf-8' ) as f:
+                json.dump( state, f, separators = (',', ':') )
+            os.replace( temp, self.filename )
+        except ( OSError, TypeError, ValueError ) as e:
+            logger.error( "StateCache.save: Can not write cache file {0}: {1}".format( self.filename, e ) )
+            return False
+        logger.debug( "StateCache.save: Saved {0}".format( self.filename ) )
+        return True
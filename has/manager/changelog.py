@@ -0,0 +1,458 @@
+# Copyright (c) Klaudisz Staniek.
+# See LICENSE for details.
+
+"""
+Value change log implementation
+
+"""
+
+from has.utils.event import Event
+from has.manager.value import ValueID
+
+import json
+import mmap
+import os
+import re
+import struct
+from threading import Thread, Lock
+from time import time, monotonic
+
+"fcntl is not available on all the platforms. Without it the directory lock is not taken"
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import logging
+logger = logging.getLogger('manager')
+
+
+class ChangeLog(object):
+    """
+    Append-only log of the value changes on the local disk.
+
+    Changes are kept in the segment files of fixed size binary records (value index, log time, epoch, value).
+    Value index is persistent: ValueIDs are numbered in the order of the first appearance
+    and the table is kept in values.json next to the segments. Only the numeric values
+    (number, bool and epoch codecs) are logged.
+
+    The log is opened with open and closed with close. The lock file in the directory
+    is held while the log is open, so two logs can not write the same directory.
+    Segment headers are read once on open and kept in memory.
+
+    Records are ordered, searched and expired by the log time: the wall clock at open advanced
+    by the monotonic clock and never lower than the last logged time, so it does not go backwards
+    when the wall clock is changed. The epoch is kept for display only. The time ranges
+    given to scan are converted to the log time with the current clocks offset.
+
+    append only queues the record. The commit thread writes the queued records to the
+    memory mapped segment, flushes it and updates the segment header (group commit).
+    The commit thread also deletes the segments older than retention and compacts
+    the segments older than compact_after: consecutive records of the value with no delta are dropped
+    and, if compact_resolution is set, only the last record per value and resolution interval is kept.
+
+    Segment file: header followed by the records ordered by the commit time
+        header  :    magic, record count, first log time, last log time, flags
+        record  :    value index (uint32), log time (double), epoch (double), value (double)
+    """
+    magic = b'HASLOG02'
+    header = struct.Struct('<8sQddII')
+    header_size = 64
+    record = struct.Struct('<Iddd')
+
+    Flag_Closed = 1
+    Flag_Compacted = 2
+
+    __segment_name = re.compile(r'^segment-(\d+)\.log$')
+
+    def __init__(self, directory, segment_records=65536, retention=90*86400, commit_interval=1.0,
+                 compact_after=86400, compact_resolution=0):
+        """
+        Params:
+            directory           :    directory of the segment files (created if not exists)
+            segment_records     :    maximum number of the records per segment
+            retention           :    seconds the records are kept
+            commit_interval     :    seconds between the group commits
+            compact_after       :    seconds after which the closed segment is compacted, 0 - no compaction
+            compact_resolution  :    seconds, keep the last record per value and interval when compacting
+        """
+        self.directory = directory
+        self.segment_records = segment_records
+        self.retention = retention
+        self.commit_interval = commit_interval
+        self.compact_after = compact_after
+        self.compact_resolution = compact_resolution
+
+        self.__pending = []
+        self.__pending_lock = Lock()
+        self.__segments_lock = Lock()
+        self.__commit_event = Event("ChangeLog")
+        self.__running = False
+
+        self.__indexes = {}     # ValueID -> value index
+        self.__value_ids = []   # value index -> ValueID
+        self.__saved_ids = 0
+
+        self.__segment = None   # current segment: [number, file, mmap, count, first log time, last log time]
+        self.__segments = {}    # segment number -> [count, first log time, last log time, flags]
+        self.__next_number = 0  # number of the next segment
+        self.__time_base = time()           # log time at __monotonic_base
+        self.__monotonic_base = monotonic()
+        self.__last_time = 0.0              # last logged time
+        self.__lock_file = None
+        self.__thread = None
+        self.committed = 0
+        self.compacted = 0
+
+    def open(self):
+        """
+        Lock the directory, load the value ids and the segment headers and start the commit thread.
+        Returns False if the directory is used by another log.
+        """
+        if self.__running:
+            return True
+        os.makedirs( self.directory, exist_ok=True )
+        lock_file = open( os.path.join( self.directory, "lock" ), 'a' )
+        if fcntl is not None:
+            try:
+                fcntl.flock( lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except OSError:
+                lock_file.close()
+                logger.error("ChangeLog.open: Directory {0} is used by another change log".format( self.directory ) )
+                return False
+        self.__lock_file = lock_file
+
+        self.__load_value_ids()
+        self.__load_segments()
+        self.__open_last_segment()
+        self.__last_time = max( ( header[2] for header in self.__segments.values() ), default=0.0 )
+        self.__time_base = max( time(), self.__last_time )
+        self.__monotonic_base = monotonic()
+
+        self.__thread = Thread( target=self.__run, name="ChangeLog" )
+        self.__thread.daemon = True
+        self.__running = True
+        self.__thread.start()
+        return True
+
+# --------------- writing --------------------
+
+    def append(self, value_id, epoch, stamp, value):
+        """
+        Queue the value change. Called from Value.update.
+
+        Params:
+            value_id    :    ValueID object
+            epoch       :    epoch timestamp of the change
+            stamp       :    monotonic timestamp of the change
+            value       :    native value (bool, int or float)
+        """
+        with self.__pending_lock:
+            self.__pending.append( ( value_id, epoch, stamp, value ) )
+
+    def __now(self):
+        """ Returns the current log time """
+        return self.__time_base + monotonic() - self.__monotonic_base
+
+    def flush(self):
+        """
+        Commit the queued records now
+        """
+        with self.__segments_lock:
+            self.__commit()
+
+    def close(self):
+        """
+        Commit the queued records, stop the commit thread and release the directory lock
+        """
+        if not self.__running:
+            return
+        self.__running = False
+        self.__commit_event.set()
+        self.__thread.join()
+        self.__thread = None
+        with self.__segments_lock:
+            self.__commit()
+            self.__close_segment( False )
+        self.__lock_file.close()
+        self.__lock_file = None
+
+    def __run(self):
+        logger.debug("ChangeLog.run: Commit thread started")
+        while self.__running:
+            self.__commit_event.wait( self.commit_interval )
+            self.__commit_event.clear()
+            try:
+                with self.__segments_lock:
+                    self.__commit()
+                self.__maintain()
+            except Exception as e:
+                logger.error("ChangeLog.run: Exception {0}".format( e ) )
+        logger.debug("ChangeLog.run: Commit thread stopped")
+
+    def __commit(self):
+        with self.__pending_lock:
+            pending, self.__pending = self.__pending, []
+        if not pending:
+            return
+
+        records = []
+        last_time = self.__last_time
+        offset = self.__time_base - self.__monotonic_base
+        for value_id, epoch, stamp, value in pending:
+            index = self.__indexes.get( value_id )
+            if index is None:
+                index = len( self.__value_ids )
+                self.__indexes[value_id] = index
+                self.__value_ids.append( value_id )
+            last_time = max( last_time, stamp + offset )
+            records.append( ( index, last_time, epoch, float( value ) ) )
+        self.__last_time = last_time
+        if len( self.__value_ids ) > self.__saved_ids:
+            self.__save_value_ids()   # before the records referring them
+
+        pack = self.record.pack
+        size = self.record.size
+        position = 0
+        while position < len( records ):
+            segment = self.__segment
+            if segment is None or segment[3] >= self.segment_records:
+                segment = self.__roll_segment()
+            number, f, mm, count, first, last = segment
+            chunk = records[ position : position + self.segment_records - count ]
+            offset = self.header_size + count * size
+            mm[ offset : offset + len( chunk ) * size ] = b''.join( pack( *record ) for record in chunk )
+            segment[3] = count + len( chunk )
+            segment[4] = chunk[0][1] if count == 0 else first
+            segment[5] = chunk[-1][1]
+            position += len( chunk )
+            mm.flush()
+            self.__write_header( mm, segment[3], segment[4], segment[5], 0 )
+            mm.flush( 0, min( mmap.PAGESIZE, len( mm ) ) )
+            self.__segments[number] = [ segment[3], segment[4], segment[5], 0 ]
+        self.committed += len( records )
+
+    @classmethod
+    def __write_header(cls, mm, count, first, last, flags):
+        mm[ 0 : cls.header.size ] = cls.header.pack( cls.magic, count, first, last, flags, 0 )
+
+# --------------- segments --------------------
+
+    def __path(self, number):
+        return os.path.join( self.directory, "segment-{0:08d}.log".format( number ) )
+
+    def __load_segments(self):
+        """
+        Read the headers of the segments in the directory. Segments of the other format are skipped
+        """
+        self.__segments = {}
+        self.__next_number = 0
+        for name in os.listdir( self.directory ):
+            match = self.__segment_name.match( name )
+            if match:
+                number = int( match.group(1) )
+                self.__next_number = max( self.__next_number, number + 1 )
+                header = self.__read_header( self.__path( number ) )
+                if header is not None:
+                    self.__segments[number] = list( header )
+                else:
+                    logger.error("ChangeLog: Segment {0} skipped (unknown format)".format( number ) )
+
+    def __read_header(self, path):
+        with open( path, 'rb' ) as f:
+            data = f.read( self.header.size )
+        if len( data ) < self.header.size:
+            return None
+        magic, count, first, last, flags, reserved = self.header.unpack( data )
+        if magic != self.magic:
+            return None
+        return count, first, last, flags
+
+    def __open_last_segment(self):
+        if not self.__segments:
+            return
+        number = max( self.__segments )
+        header = self.__segments[number]
+        if header[3] & self.Flag_Closed or header[0] >= self.segment_records:
+            return
+        count, first, last, flags = header
+        f = open( self.__path( number ), 'r+b' )
+        mm = mmap.mmap( f.fileno(), 0 )
+        if len( mm ) < self.header_size + self.segment_records * self.record.size:
+            mm.close()
+            f.close()
+            return
+        self.__segment = [ number, f, mm, count, first, last ]
+
+    def __roll_segment(self):
+        """
+        Close the current segment and create the next one
+        """
+        number = self.__next_number
+        self.__next_number = number + 1
+        self.__close_segment( True )
+        size = self.header_size + self.segment_records * self.record.size
+        f = open( self.__path( number ), 'w+b' )
+        f.truncate( size )
+        mm = mmap.mmap( f.fileno(), size )
+        self.__write_header( mm, 0, 0.0, 0.0, 0 )
+        self.__segment = [ number, f, mm, 0, 0.0, 0.0 ]
+        self.__segments[number] = [ 0, 0.0, 0.0, 0 ]
+        logger.debug("ChangeLog: Segment {0} created".format( number ) )
+        return self.__segment
+
+    def __close_segment(self, final):
+        segment = self.__segment
+        if segment is None:
+            return
+        number, f, mm, count, first, last = segment
+        if final:
+            self.__write_header( mm, count, first, last, self.Flag_Closed )
+            self.__segments[number][3] = self.Flag_Closed
+        mm.flush()
+        mm.close()
+        f.close()
+        self.__segment = None
+
+    def __maintain(self):
+        """
+        Delete the segments older than retention and compact one old segment
+        """
+        now = self.__now()
+        with self.__segments_lock:
+            current = self.__segment[0] if self.__segment is not None else None
+            segments = sorted( ( number, tuple( header ) ) for number, header in self.__segments.items() if number != current )
+        for number, ( count, first, last, flags ) in segments:
+            path = self.__path( number )
+            if last < now - self.retention:
+                with self.__segments_lock:
+                    os.remove( path )
+                    del self.__segments[number]
+                logger.info("ChangeLog: Segment {0} removed (retention)".format( number ) )
+            elif self.compact_after > 0 and not flags & self.Flag_Compacted and last < now - self.compact_after:
+                self.__compact( number, path, count )
+                return   # one segment per commit cycle
+
+    def __compact(self, number, path, count):
+        with open( path, 'rb' ) as f:
+            f.seek( self.header_size )
+            data = f.read( count * self.record.size )
+        records = list( self.record.iter_unpack( data ) )
+
+        kept = []
+        last_values = {}
+        slots = {}    # (index, interval) -> position in kept
+        resolution = self.compact_resolution
+        for record in records:
+            index, log_time, epoch, value = record
+            if last_values.get( index ) == value:
+                continue   # no delta
+            last_values[index] = value
+            if resolution > 0:
+                key = ( index, int( log_time // resolution ) )
+                position = slots.get( key )
+                if position is not None:
+                    kept[position] = None   # superseded by the later record in the interval
+                slots[key] = len( kept )
+            kept.append( record )
+        kept = [ record for record in kept if record is not None ]
+
+        first = min( ( record[1] for record in kept ), default=0.0 )
+        last = max( ( record[1] for record in kept ), default=0.0 )
+        temp = path + ".tmp"
+        with open( temp, 'wb' ) as f:
+            f.write( self.header.pack( self.magic, len( kept ), first, last,
+                                       self.Flag_Closed | self.Flag_Compacted, 0 ).ljust( self.header_size, b'\0' ) )
+            f.write( b''.join( self.record.pack( *record ) for record in kept ) )
+        with self.__segments_lock:
+            os.replace( temp, path )
+            self.__segments[number] = [ len( kept ), first, last, self.Flag_Closed | self.Flag_Compacted ]
+        self.compacted += len( records ) - len( kept )
+        logger.info("ChangeLog: Segment {0} compacted {1} -> {2} records".format( number, len( records ), len( kept ) ) )
+
+# --------------- value ids --------------------
+
+    def __load_value_ids(self):
+        path = os.path.join( self.directory, "values.json" )
+        try:
+            with open( path, 'r', encoding='utf-8' ) as f:
+                components = json.load( f )
+        except FileNotFoundError:
+            return
+        for network_id, node_id, value_type in components:
+            value_id = ValueID( network_id, node_id, value_type )
+            self.__indexes[value_id] = len( self.__value_ids )
+            self.__value_ids.append( value_id )
+        self.__saved_ids = len( self.__value_ids )
+
+    def __save_value_ids(self):
+        path = os.path.join( self.directory, "values.json" )
+        temp = path + ".tmp"
+        with open( temp, 'w', encoding='utf-8' ) as f:
+            json.dump( [ [ value_id.network_id, value_id.node_id, value_id.value_type ] for value_id in self.__value_ids ], f )
+        os.replace( temp, path )
+        self.__saved_ids = len( self.__value_ids )
+
+# --------------- reading --------------------
+
+    def scan(self, start=0, end=None, value_ids=None):
+        """
+        Generator of (ValueID, epoch, value) tuples of the committed changes in the time range, in the log order.
+        Only the segments overlapping the range (see the segment headers kept in memory) are opened. They are memory mapped
+        and the first record is found with the binary search, so only the pages in the range are read.
+
+        Params:
+            start       :    epoch timestamp, inclusive
+            end         :    epoch timestamp, inclusive (no limit if None)
+            value_ids   :    iterable of ValueID objects (all values if None)
+        """
+        offset = time() - self.__now()   # epoch - log time
+        start = start - offset
+        end = float('inf') if end is None else end - offset
+        indexes = None
+        if value_ids is not None:
+            indexes = set( self.__indexes[value_id] for value_id in value_ids if value_id in self.__indexes )
+            if not indexes:
+                return
+        size = self.record.size
+        unpack = self.record.unpack_from
+
+        with self.__segments_lock:
+            numbers = sorted( number for number, ( count, first, last, flags ) in self.__segments.items()
+                              if count > 0 and last >= start and first <= end )
+        for number in numbers:
+            path = self.__path( number )
+            try:
+                f = open( path, 'rb' )
+            except FileNotFoundError:
+                continue   # removed by the retention
+            with f:
+                header = f.read( self.header.size )
+                if len( header ) < self.header.size:
+                    continue
+                magic, count, first, last, flags, reserved = self.header.unpack( header )
+                if magic != self.magic or count == 0 or last < start or first > end:
+                    continue
+                with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as mm:
+                    low, high = 0, count
+                    while low < high:
+                        middle = ( low + high ) // 2
+                        if unpack( mm, self.header_size + middle * size )[1] < start:
+                            low = middle + 1
+                        else:
+                            high = middle
+                    for position in range( low, count ):
+                        index, log_time, epoch, value = unpack( mm, self.header_size + position * size )
+                        if log_time > end:
+                            break
+                        if indexes is None or index in indexes:
+                            yield self.__value_ids[index], epoch, value
+
+    def stats(self):
+        """
+        Returns the dictionary with the number of the segments, committed, pending and compacted records
+        """
+        with self.__pending_lock:
+            pending = len( self.__pending )
+        return dict( segments = len( self.__segments ), committed = self.committed,
+                     pending = pending, compacted = self.compacted, values = len( self.__value_ids ) )
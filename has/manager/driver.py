@@ -8,14 +8,16 @@ TODO: Implement driver for iTach, Logitech Radio, CEC Library, Withings Scale, e
 """
 
 
-from has.utils.event import Event, Wait, Watcher
+from has.utils.event import Event, Wait, Watcher, RWLock
 from has.utils.notification import Notification
 from has.manager.hc2.hc2nodes import value_types
 from has.manager.node import Node
 
 import json
 import time
+from collections import deque
 from threading import Thread, Lock
+from time import monotonic
 import logging
 logger = logging.getLogger('manager')
 
@@ -26,21 +28,174 @@ class MsgQueueItem:
     MsgQueueCmd_SendMsg, \
     MsgQueueCmd_QueryStageComplete = range(2)
     
+    __slots__ = ( 'command', 'msg', 'params', 'method', 'query_stage', 'retry', 'node_id', 'lane', 'expires', 'key' )
     
-    def _init__(self):
-        self.command = None
-        self.msg = None
-        self.params = None
-        self.method = 'GET'
-        self.query_stage = None
+    def __init__(self, command=None, msg=None, params=None, method='GET', query_stage=None, node_id=0):
+        self.command = command
+        self.msg = msg
+        self.params = params
+        self.method = method
+        self.query_stage = query_stage
         self.retry = False
-        self.node_id = 0
+        self.node_id = node_id
+        self.lane = None
+        self.expires = None
+        self.key = None
+
+
+class MsgScheduler(Event):
+    """
+    Multi-priority message queue.
+    Each priority (lane) is a bounded deque, lower lane number has higher priority.
+    The Event is set as long as any of the lanes holds the message.
+    Messages queued as unique are deduplicated by (method, url) until sent.
+    Essential messages (QueryStageComplete items and messages put as essential)
+    never expire and are accepted even if the lane is full.
+    """
+    def __init__(self, name, sizes, ttls, on_expired=None):
+        """
+        Params:
+            name        :    name of the Event
+            sizes       :    tuple with the maximum number of items per lane
+            ttls        :    tuple with the time to live in seconds of the messages per lane (None - forever)
+            on_expired  :    function called with the expired item (outside the queue lock)
+        """
+        Event.__init__(self, name)
+        self.__lanes = tuple( deque() for size in sizes )
+        self.__sizes = tuple( sizes )
+        self.__ttls = tuple( ttls )
+        self.__lock = Lock()
+        self.__unique = {}
+        self.__on_expired = on_expired
+        self.rejected = [0] * len(sizes)
+        self.expired = [0] * len(sizes)
+        self.deduplicated = 0
+    
+    def __len__(self):
+        return sum( len(lane) for lane in self.__lanes )
+    
+    def pending(self, lane=None):
+        """
+        Returns True if there is a message queued in the lane (any lane if None)
+        """
+        if lane is None:
+            return any( self.__lanes )
+        return len( self.__lanes[lane] ) > 0
+    
+    def is_queued(self, method, msg):
+        """
+        Returns True if the unique message is waiting in the queue
+        """
+        return ( method, msg ) in self.__unique
+    
+    def discard(self, method, msg):
+        """
+        Cancel the unique message waiting in the queue. Returns True if cancelled.
+        """
+        with self.__lock:
+            item = self.__unique.pop( ( method, msg ), None )
+            if item is not None:
+                item.command = None   # skipped by get
+                return True
+        return False
+    
+    def put(self, lane, item, ttl=None, unique=False, essential=False):
+        """
+        Append the item to the lane. Returns False if the lane is full.
+        
+        Params:
+            lane        :    lane number
+            item        :    MsgQueueItem object
+            ttl         :    time to live in seconds, lane default used if None
+            unique      :    drop the message if the same (method, url) is already queued
+            essential   :    message never expires and is not rejected when the lane is full
+        """
+        essential = essential or item.command == MsgQueueItem.MsgQueueCmd_QueryStageComplete
+        if ttl is None:
+            ttl = self.__ttls[lane]
+        item.lane = lane
+        if ttl is not None and not essential:
+            item.expires = monotonic() + ttl
+        
+        with self.__lock:
+            queue = self.__lanes[lane]
+            if len(queue) >= self.__sizes[lane] and not essential:
+                self.rejected[lane] += 1
+                logger.error("MsgScheduler.put: Lane {0} full. Message {1} rejected".format( lane, item.msg ) )
+                return False
+            if unique:
+                key = ( item.method, item.msg )
+                if key in self.__unique:
+                    self.deduplicated += 1
+                    logger.debug("MsgScheduler.put: Message {0} already queued".format( item.msg ) )
+                    return True
+                item.key = key
+                self.__unique[key] = item
+            queue.append(item)
+            self.set()
+        return True
+    
+    def get(self, lane=None):
+        """
+        Pop the oldest item from the highest priority non empty lane (or from the given lane).
+        Expired messages are dropped. Returns None if there is no message.
+        """
+        lanes = self.__lanes if lane is None else ( self.__lanes[lane], )
+        item = None
+        expired = []
+        with self.__lock:
+            now = None
+            for queue in lanes:
+                while queue:
+                    item = queue.popleft()
+                    if item.key is not None:
+                        if self.__unique.get( item.key ) is item:
+                            del self.__unique[item.key]
+                    if item.command is None:  # cancelled
+                        item = None
+                        continue
+                    if item.expires is not None:
+                        if now is None:
+                            now = monotonic()
+                        if item.expires < now:
+                            self.expired[item.lane] += 1
+                            logger.debug("MsgScheduler.get: Message {0} expired".format( item.msg ) )
+                            expired.append( item )
+                            item = None
+                            continue
+                    break
+                if item is not None:
+                    break
+            
+            if not any( self.__lanes ):
+                self.clear()
+        if self.__on_expired is not None:
+            for expired_item in expired:
+                self.__on_expired( expired_item )
+        return item
+    
+    def reset(self):
+        """
+        Drop all the queued messages
+        """
+        with self.__lock:
+            for queue in self.__lanes:
+                queue.clear()
+            self.__unique.clear()
+            self.clear()
 
 
 class Driver(Thread):
     """Generic driver class"""
     MsgQueue_Command, \
-    MsgQueue_Query = range(2)
+    MsgQueue_Refresh, \
+    MsgQueue_Query = range(3)
+    
+    """
+    Maximum number of the messages and the message time to live per queue
+    """
+    MsgQueue_Sizes = ( 1000, 100, 10000 )
+    MsgQueue_TTLs = ( None, None, 300 )
     
     def __init__(self, network):
         Thread.__init__(self)
@@ -48,18 +203,20 @@ class Driver(Thread):
         self.network_id = network
         self.running = 0
         self.exit_event = Event("Exit")
-        self.notifications = []
+        self.notifications = deque()
         self.notifications_event = Event("Notification")
-        self.msg_queue = {}
-        self.msg_queue[0] = []
-        self.msg_queue[1] = []
-        self.queue_event = {}
-        self.queue_event[0] = Event("Command")
-        self.queue_event[1] = Event("Query")
-        self.send_lock = Lock()
+        self.flush_requested = False   # watcher batches due, see request_flush
+        self.msg_queue = MsgScheduler("MsgQueue", self.MsgQueue_Sizes, self.MsgQueue_TTLs, self.handle_msg_failed)
         self.nodes = {}
-        self.node_lock = Lock()
+        self.node_lock = RWLock()   # shared by readers, exclusive for the driver updates
         self.all_nodes_queried = False
+        self.pending_nodes = set()   # ids of the nodes with the queries not complete
+        self.cache_loaded = False    # True if the nodes were loaded from the state cache
+        self.bootstrap_times = {}    # initial data request -> seconds from the request to the handled response
+        self.value_store = None   # ValueStore if values are kept in columnar store
+        self.history_depth = 0    # number of the value changes kept per value, 0 - no history
+        self.history_window = 600 # value statistics window in seconds
+        self.changelog = None     # ChangeLog receiving the value changes
         
     def __repr__(self):
         return "Driver: %s" % self.network_id
@@ -67,7 +224,7 @@ class Driver(Thread):
     def stop(self):
         self.exit_event.set()
         
-        self.notifications = []
+        self.notifications.clear()
         self.notifications_event.notify()
         
         if self.controller:
@@ -86,58 +243,87 @@ class Driver(Thread):
     def set_manager(self, manager):
         self.manager = manager
         
-    def queue_notification(self, notification):  # TODO: Migrate to Queue
-        self.notifications.insert(0, notification )
+    def queue_notification(self, notification):
+        self.notifications.append( notification )
         self.notifications_event.set()
         
         
     def notify_watchers(self):
-        while len(self.notifications) > 0:
-            notification = self.notifications.pop()
+        """
+        Deliver all the queued notifications. Returns the number of notifications delivered
+        """
+        count = 0
+        self.notifications_event.clear()  # before draining - notification queued in the meantime sets it again
+        flush, self.flush_requested = self.flush_requested, False
+        while self.notifications:
+            notification = self.notifications.popleft()
             self.manager.notify_watchers(notification)
-        self.notifications_event.clear()
+            count += 1
+        if count or flush:
+            self.manager.flush_watchers( self )
+        return count
+    
+    def request_flush(self):
+        """
+        Request the delivery of the due watcher batches from the driver thread.
+        Called from the batch watcher timer thread.
+        """
+        self.flush_requested = True
+        self.notifications_event.set()
             
     
     def init_node(self, node_id):
         raise NotImplemented
         return
     
-    def check_completed_node_queries(self):
-        logger.info("Driver.check_completed_node_queries: all_nodes_queried={0}".format(self.all_nodes_queried))
-        if not self.all_nodes_queried:
-            all_queried = True
-            #logger.debug("Driver.check_completed_node_queries: all_nodes_queried={0}".format(self.all_nodes_queried))
-            with self.node_lock:
-                for node_id, node in self.nodes.items():
-                    #logger.debug("Driver.check_completed_node_queries: Node {0}".format( node_id, node.query_stage ) )
-                    if node.query_stage != Node.QueryStage_Complete:
-                        logger.debug("Driver.check_completed_node_queries: Node {0}".format( node_id, node.query_stage ) )
-                        all_queried = False
-                        break
-    
-            if all_queried:
-                logger.info("Driver.Node query processing complete")
-                notification = Notification( Notification.Type_AllNodesQueried )
-                self.queue_notification( notification )
-                self.all_nodes_queried = True
-                self.handle_all_nodes_queried()   # must be implemented by the specfic driver
+    def check_completed_node_queries(self, node_id=None):
+        """
+        Called when the node queries are complete. AllNodesQueried is sent once when no node
+        is pending and the initial node lists are received (see initial_nodes_received).
+        Pending nodes are tracked in the set, so the check does not scan the nodes.
+        
+        Params:
+            node_id     :    id of the node which completed the queries
+        """
+        if node_id is not None:
+            self.pending_nodes.discard( node_id )
+        if self.all_nodes_queried or self.pending_nodes or not self.initial_nodes_received():
+            return
+        
+        logger.info("Driver.Node query processing complete")
+        notification = Notification( Notification.Type_AllNodesQueried, self.network_id )
+        self.queue_notification( notification )
+        self.all_nodes_queried = True
+        self.handle_all_nodes_queried()   # must be implemented by the specfic driver
+    
+    def initial_nodes_received(self):
+        """
+        Returns True if the driver received the lists of all the nodes. Overridden by the specific driver
+        """
+        return True
                
     
     def send_query_stage_complete(self, node_id, stage):
         logger.debug("Driver.send_query_stage_complete: Node {0}: Stage {1}".format( node_id, stage ) )
-        item = MsgQueueItem()
-        item.command = MsgQueueItem.MsgQueueCmd_QueryStageComplete
-        item.node_id = node_id
-        item.query_stage = stage
+        item = MsgQueueItem( MsgQueueItem.MsgQueueCmd_QueryStageComplete, node_id = node_id, query_stage = stage )
         
         node = self.get_node( node_id )
         if node is not None:
             logger.debug("Node {0}: Queueing Query Stage Complete {1}".format( node_id, stage ) )
-            with self.send_lock:
-                self.msg_queue[Driver.MsgQueue_Query].insert(0, item)
-                self.queue_event[Driver.MsgQueue_Query].set()    
+            self.msg_queue.put( Driver.MsgQueue_Query, item )
             self.release_nodes()
             
+    def handle_msg_failed(self, item):
+        """
+        Called when the message expired in the queue or was rejected. The node waiting
+        for the response of the query is notified (see Node.query_failed).
+        """
+        if item.command != MsgQueueItem.MsgQueueCmd_SendMsg or not item.node_id:
+            return
+        node = self.get_node_unsafe( item.node_id )
+        if node is not None:
+            node.query_failed()
+    
     def handle_all_nodes_queried(self):
         raise NotImplemented
         return
@@ -158,47 +344,71 @@ class Driver(Thread):
         except:
             return None
     
+    def get_node_shared(self, node_id):
+        """
+        Returns the node with nodes locked for reading (release with release_nodes_shared)
+        or None if node does not exist
+        """
+        self.lock_nodes_shared()
+        try:
+            return self.nodes[node_id]
+        except:
+            self.release_nodes_shared()
+            return None
+    
     def lock_nodes(self):
+        """
+        Exclusive lock used when nodes are modified
+        """
         self.node_lock.acquire()
     
     def release_nodes(self):
         self.node_lock.release()
+    
+    def lock_nodes_shared(self):
+        """
+        Shared lock used by readers. Many readers can hold it at the same time.
+        """
+        self.node_lock.acquire_read()
+    
+    def release_nodes_shared(self):
+        self.node_lock.release_read()
 
 
     def get_node_type( self, node_id ):
-        node = self.get_node( node_id )
+        node = self.get_node_shared( node_id )
         if node:
             res = node.node_type
-            self.release_nodes()
+            self.release_nodes_shared()
             return res
         return "Unknown"
         
     def get_node_name( self, node_id ):
-        node = self.get_node( node_id )
+        node = self.get_node_shared( node_id )
         if node:
             res = node.name
-            self.release_nodes()
+            self.release_nodes_shared()
             return res
         return "Unknown"
         
     def get_node_description( self, node_id ):
-        node = self.get_node( node_id )
+        node = self.get_node_shared( node_id )
         res = ""
         if node:
             res = node.description
-            self.release_nodes()
+            self.release_nodes_shared()
         return res
 
     def get_node_location_name( self, node_id ):
-        node = self.get_node( node_id )
+        node = self.get_node_shared( node_id )
         if node:
             res = node.location_name
-            self.release_nodes()
+            self.release_nodes_shared()
             return res
         return "Unknown"
 
     def get_value(self, value_id):
-        node = self.nodes[value_id.node_id]
+        node = self.nodes.get( value_id.node_id )
         if node:
             return node.get_value( value_id )
         return None
@@ -12,18 +12,20 @@ import urllib.parse
 from urllib.error import HTTPError, URLError
 import http.cookiejar
 
-from http.client import HTTPConnection, BadStatusLine, ResponseNotReady, CannotSendRequest, HTTPException
+from http.client import HTTPConnection, HTTPSConnection, BadStatusLine, ResponseNotReady, CannotSendRequest, HTTPException
 from base64 import b64encode
 import string
 import socket
+import ssl
 from queue import PriorityQueue, Queue, Empty
-from threading import Thread
+from threading import Thread, Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
 import re
 from random import random
 
 import logging
 from socket import timeout, gaierror, gethostbyname, herror, _GLOBAL_DEFAULT_TIMEOUT
-from time import time
+from time import time, monotonic
 
 from has.utils.event import Wait
 
@@ -31,62 +33,53 @@ import logging
 logger = logging.getLogger('manager')
 
 
-class ResponseHandler(urllib.request.BaseHandler):
+"""
+Maximum number of the redirects followed by HC2Controller.send
+"""
+max_redirects = 5
+
+
+class ResponseHandler(object):
     def __init__(self, parent_class):
         self.__parent_class = parent_class
         self.__handlers = dict (  api_refreshStates = self.__handle_api_refreshStates,
                                 api_loginStatus = self.__handle_api_loginStatus,
                                 default = self.__handle_default,
                                 proxy = self.__handle_proxy)
-        super().__init__()
-    
-    def http_response(self, request, response):
-        return self._response(request, response)
     
-    def https_response(self, request, response):
-        return self._response(request, response)
-    
-    def _response(self, request, response):
-        command, parameters = self.__decode_command(request)
+    def handle(self, selector, status, response):
+        """
+        Handle the HTTP response
+        
+        Params:
+            selector:   request path with the query
+            status:     HTTP status code
+            response:   response body (bytes)
+        """
+        command, parameters = self.__decode_command(selector)
         logger.debug("ResponseHandler: COMMAND {0}, PARAMS: {1}".format(command, parameters))
         
-        #print("contoller: handle response")
-        #print("----request------")
-        #print(request.full_url)
-        #print(request.type)
-        #print(request.selector)
-        #print(request.data)
-        #print(request.method)
-        #print('---response-------')
-        #print(response.info())
-        #print("Response msg:%s" % response.msg)
-        #print(response.status)
-        #print("COMMAND: %s, PARAMS: %s" % (command, parameters))
-        #print('---done-------')
-        
-        if response.status == 200:
+        if status == 200:
             if command in self.__handlers:
-                return self.__handlers[command](command, parameters, response)
+                self.__handlers[command](command, parameters, response)
             else:
-                return self.__handle_command(command, parameters, response)
-            
-        return response
+                self.__handle_command(command, parameters, response)
         
     def __response_read(self, response):
-        return response.read().decode('UTF-8')
+        return response.decode('UTF-8')
     
-    def __decode_command(self, request):
+    def __decode_command(self, selector):
         command = "default"
         parameters = {}
-        selector = urllib.parse.unquote(request.selector)
-        match = re.search("/(api/[a-z|A-Z|/]*)\?*(.*)", selector)
+        unquoted = urllib.parse.unquote(selector)
+        match = re.search("/(api/[a-z|A-Z|/]*)\?*(.*)", unquoted)
         if match:
             command = match.group(1).replace('/','_')
             qs = match.group(2)
             parameters = urllib.parse.parse_qs(qs)
             #print("PARAMS: %s" % parameters)
             
-        elif request.selector == "/fibaro/index.php":
+        elif selector == "/fibaro/index.php":
             command = 'proxy' 
         
         return command, parameters
@@ -98,7 +91,6 @@ class ResponseHandler(urllib.request.BaseHandler):
             self.__parent_class.proxy = "/newProxyLite" + match.group(1) + "&req="
         else:
             self.__parent_class.proxy = ""
-        return response
         
     def __handle_api_loginStatus(self, command, parameters, response):
         result = self.__response_read(response)
@@ -111,8 +103,6 @@ class ResponseHandler(urllib.request.BaseHandler):
             else:
                 self.__parent_class.tx_put('GET','/api/home')
                 self.__parent_class.tx_put('GET','/api/loginStatus')
-                
-        return response
             
     def __handle_api_refreshStates(self, command, parameters, response):
         result = self.__response_read(response)
@@ -122,46 +112,167 @@ class ResponseHandler(urllib.request.BaseHandler):
             #print("LAST_REFRESH:%s" % self.parent_class.last_refresh)
         self.__parent_class.rx_put( command, parameters, result )
         self.__parent_class.tx_put('GET','/api/refreshStates')
-        return response
     
     def __handle_command(self, command, parameters, response):
         #print("HANDLE COMMAND:%s" % command)
         result = self.__response_read(response)
         self.__parent_class.rx_put( command, parameters, result )
-        return response
     
     def __handle_default(self, command, parameters, response):
         #print("HANDLE DEFAULT:%s" % command)
-        return response
+        return
     
             
 
-class HC2HTTPBasicAuthHandler(urllib.request.HTTPBasicAuthHandler):
+class ConnectionPool(object):
     """
-    Extension to http_error_401 setting the auth_required flag to True
-    when authentication required.
-    It can add the authentication header to the requests avoiding request to be resend with auth header.
+    Pool of the persistent (keep-alive) HTTP connections to the single host.
+    The host name is resolved once and the address is cached for dns_ttl seconds
+    or until the connection to it fails. At most max_size connections are used at once
+    (request blocks until the connection is available) and the idle connections
+    are closed after idle_timeout seconds.
     """
-    def __init__(self, parent_class):
+    def __init__(self, scheme, host, port, max_size=4, idle_timeout=30, timeout=60, dns_ttl=300):
         """
-        Saving the parnet class reference
-        path
+        Params:
+            scheme:         'http' or 'https'
+            host:           host name or address
+            port:           port number (scheme default if None)
+            max_size:       maximum number of the connections
+            idle_timeout:   seconds the idle connection is kept open
+            timeout:        socket timeout in seconds
+            dns_ttl:        seconds the resolved address is cached
         """
-        self.__parent_class = parent_class
-        super().__init__()
-
-    def http_error_401(self, req, fp, code, msg, headers):
+        self.scheme = scheme
+        self.host = host
+        self.port = port if port is not None else ( 443 if scheme == 'https' else 80 )
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.dns_ttl = dns_ttl
+        
+        self.opened = 0     # number of the connections opened
+        self.reused = 0     # number of the requests sent over the idle connections
+        self.retried = 0    # number of the requests retried after the reused connection failed
+        
+        self.__idle = []    # (connection, monotonic time when released), oldest first
+        self.__lock = Lock()
+        self.__slots = BoundedSemaphore( max_size )
+        self.__address = None
+        self.__resolved = 0
+        self.__context = ssl.create_default_context() if scheme == 'https' else None
+        
+    def __resolve(self):
+        with self.__lock:
+            if self.__address is None or monotonic() - self.__resolved > self.dns_ttl:
+                info = socket.getaddrinfo( self.host, self.port, 0, socket.SOCK_STREAM )
+                self.__address = info[0][4][:2]
+                self.__resolved = monotonic()
+            return self.__address
+        
+    def __create_connection(self, address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """
+        Replacement of socket.create_connection used by HTTPConnection connecting to the cached address
+        """
+        try:
+            sock = socket.create_connection( self.__resolve(), timeout, source_address )
+        except OSError:
+            self.__address = None   # resolve again next time
+            raise
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        return sock
+    
+    def __new_connection(self):
+        if self.__context is not None:
+            connection = HTTPSConnection( self.host, self.port, timeout=self.timeout, context=self.__context )
+        else:
+            connection = HTTPConnection( self.host, self.port, timeout=self.timeout )
+        connection._create_connection = self.__create_connection
+        self.opened += 1
+        return connection
+        
+    def __get(self):
+        """
+        Returns the (connection, reused) tuple. The most recently used idle connection is taken first.
         """
-        Passing request to the super class and setting the flag:
+        expired = []
+        connection = None
+        with self.__lock:
+            limit = monotonic() - self.idle_timeout
+            while self.__idle and self.__idle[0][1] < limit:
+                expired.append( self.__idle.pop(0)[0] )
+            if self.__idle:
+                connection = self.__idle.pop()[0]
+                self.reused += 1
+        for idle in expired:
+            idle.close()
+        if connection is not None:
+            return connection, True
+        return self.__new_connection(), False
+    
+    def __put(self, connection):
+        with self.__lock:
+            self.__idle.append( ( connection, monotonic() ) )
+    
+    def __request(self, connection, method, selector, body, headers):
+        try:
+            connection.request( method, selector, body, headers )
+            response = connection.getresponse()
+            data = response.read()
+        except:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.__put( connection )
+        return response, data
+            
+    def request(self, method, selector, body=None, headers={}, idempotent=False):
         """
-        response = super().http_error_401(req, fp, code, msg, headers)
-        self.__parent_class.auth_required = True
-        return response
+        Send the request and read the response. Returns the (response, body) tuple
+        where response is the http.client.HTTPResponse already read.
+        The request is retried once on the new connection if the reused connection
+        could not send it (CannotSendRequest) or, for the idempotent request only,
+        if the reused connection was closed by the server in the meantime.
+        The request which is not idempotent may have been executed before the connection dropped,
+        so it is never repeated.
         
-
+        Params:
+            idempotent  :    True if the request can be safely repeated
+        """
+        self.__slots.acquire()
+        try:
+            connection, reused = self.__get()
+            try:
+                return self.__request( connection, method, selector, body, headers )
+            except ( BadStatusLine, CannotSendRequest, ConnectionError ) as e:
+                if not reused or not ( idempotent or isinstance( e, CannotSendRequest ) ):
+                    raise
+                logger.debug("ConnectionPool.request: Idle connection to {0} failed ({1}). Retrying".format( self.host, repr( e ) ) )
+                self.retried += 1
+                return self.__request( self.__new_connection(), method, selector, body, headers )
+        finally:
+            self.__slots.release()
+    
+    def close(self):
+        """
+        Close the idle connections
+        """
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for connection, released in idle:
+            connection.close()
+    
+    def get_stats(self):
+        with self.__lock:
+            idle = len( self.__idle )
+        return dict( opened = self.opened, reused = self.reused, retried = self.retried, idle = idle )
+    
     
 class HC2Controller(Event, Thread):
-    def __init__(self, host, username, password, port=80, remote=False, remote_server=None, remote_username=None, remote_password=None):
+    def __init__(self, host, username, password, port=80, remote=False, remote_server=None, remote_username=None, remote_password=None,
+                 max_connections=4, idle_timeout=30):
         Event.__init__(self, "Controller")
         Thread.__init__(self)
         self.proxy = None
@@ -172,7 +283,6 @@ class HC2Controller(Event, Thread):
         self.remote_password = remote_password
         
         self.auth = b64encode(("%s:%s" % (username, password)).encode('ascii')).decode('ascii')
-        self.auth_required = False
         
         self.__rx_queue = Queue()
         self.__tx_queue = Queue()
@@ -180,20 +290,25 @@ class HC2Controller(Event, Thread):
         self.last_refresh = None
         self.__running = False
         
+        """
+        Pool of threads sending the requests concurrently (see send_many and send_async)
+        """
+        self.max_connections = max_connections
+        self.__pool = None
+        
         self.connected_event = Event("Connected")
         self.connected = False
 
-        cj = http.cookiejar.CookieJar()
-        cookie_handler = urllib.request.HTTPCookieProcessor(cj)
-        password_handler = HC2HTTPBasicAuthHandler(self)
-        if self.remote:
-            url = "https://" + self.remote_server  + "/newProxyLite"
-        else:
-            url = "http://" + self.host 
-        
-        password_handler.add_password("fibaro", url, username, password)
-        response_handler = ResponseHandler(self)
-        self._opener = urllib.request.build_opener( password_handler, cookie_handler, response_handler)
+        """
+        Keep-alive connection pools per (scheme, host, port). Each pool keeps up to max_connections + 2
+        connections (concurrent senders, transmit thread and driver thread), idle connections are closed after idle_timeout seconds.
+        Basic auth header is sent with every request, so no request is repeated after 401.
+        """
+        self.idle_timeout = idle_timeout
+        self.__connection_pools = {}
+        self.__connection_pools_lock = Lock()
+        self.__cookies = http.cookiejar.CookieJar()
+        self.__response_handler = ResponseHandler(self)
         
     
     def open(self, network):
@@ -274,6 +389,12 @@ class HC2Controller(Event, Thread):
         self.connected = False
         self.tx_put(None, 'exit')
         self.join()
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+        with self.__connection_pools_lock:
+            for pool in self.__connection_pools.values():
+                pool.close()
         
     
     def tx_put(self, method, url, parameters = None):
@@ -307,15 +428,112 @@ class HC2Controller(Event, Thread):
         and clear the controller Event when rx queue is empty
         """
         try:
-            message = self.__rx_queue.get()
-            if self.__rx_queue.empty():
-                self.clear()
-            return message
-
+            message = self.__rx_queue.get_nowait()
         except Empty:
+            message = None
+        
+        if self.__rx_queue.empty():
             self.clear()
-            return None
+            if not self.__rx_queue.empty():  # message put in the meantime
+                self.set()
+        return message
 
+    def send_many(self, requests):
+        """
+        Send the HTTP Requests concurrently over up to max_connections connections
+        bypassing the transmit queue. Blocks until all the requests are completed.
+        Responses are put to the receive queue as for the queued requests.
+        Returns the list of send results (True/False) in the requests order.
+        
+        Params:
+            requests:   list of (method, api, parameters) tuples
+        """
+        if not requests:
+            return []
+        if len( requests ) == 1 or self.max_connections < 2:
+            return [ self.send( *request ) for request in requests ]
+        
+        futures = [ self.__get_pool().submit( self.send, *request ) for request in requests ]
+        results = []
+        for future in futures:
+            try:
+                results.append( future.result() )
+            except Exception as e:
+                logger.error("HC2Controller.send_many: Exception {0}".format( e ) )
+                results.append( False )
+        return results
+    
+    def send_async(self, requests):
+        """
+        Send the HTTP Requests concurrently over up to max_connections connections
+        bypassing the transmit queue and without waiting for the responses.
+        Responses are put to the receive queue as they arrive, so they are handled in the completion order.
+        Failed request puts the 'error' to the receive queue as for the queued requests.
+        The requests are put to the transmit queue if max_connections is less than 2.
+        
+        Params:
+            requests:   list of (method, api, parameters) tuples
+        """
+        if self.max_connections < 2:
+            for request in requests:
+                self.tx_put( *request )
+            return
+        
+        pool = self.__get_pool()
+        for request in requests:
+            pool.submit( self.__send_async, *request )
+    
+    def __send_async(self, method, api, parameters):
+        try:
+            sent = self.send( method, api, parameters )
+        except Exception as e:
+            logger.error("HC2Controller.send_async: Exception {0}".format( e ) )
+            sent = False
+        if not sent:
+            self.rx_put('error')
+    
+    def __get_pool(self):
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor( max_workers = self.max_connections )
+        return self.__pool
+    
+    def __connection_pool(self, scheme, host, port):
+        key = ( scheme, host, port )
+        with self.__connection_pools_lock:
+            pool = self.__connection_pools.get( key )
+            if pool is None:
+                pool = ConnectionPool( scheme, host, port, self.max_connections + 2, self.idle_timeout )
+                self.__connection_pools[key] = pool
+            return pool
+    
+    def __open(self, request, idempotent):
+        """
+        Send the urllib.request.Request over the pooled connection with the cookies and Basic auth.
+        Returns the (response, body) tuple.
+        """
+        parts = urllib.parse.urlsplit( request.full_url )
+        pool = self.__connection_pool( parts.scheme, parts.hostname, parts.port )
+        
+        if parts.netloc in ( self.host, self.remote_server ):
+            request.add_header( "Authorization", "Basic %s" % self.auth )
+        if request.data is not None:
+            request.add_header( "Content-Type", "application/x-www-form-urlencoded" )
+        self.__cookies.add_cookie_header( request )
+        headers = dict( request.header_items() )
+        
+        response, body = pool.request( request.get_method(), request.selector, request.data, headers, idempotent )
+        self.__cookies.extract_cookies( response, request )
+        return response, body
+    
+    def get_connection_stats(self):
+        """
+        Returns the dictionary with the statistics (opened, reused, retried and idle connections)
+        per host of the connection pools
+        """
+        with self.__connection_pools_lock:
+            pools = list( self.__connection_pools.values() )
+        return dict( ( "{0}://{1}:{2}".format( pool.scheme, pool.host, pool.port ), pool.get_stats() ) for pool in pools )
+    
     def send(self, method, api, parameters = None):
         """
         Send the HTTP Request to HC2.
@@ -353,17 +571,26 @@ class HC2Controller(Event, Thread):
         logger.debug("REQUEST: {0} {1} {2}".format(method, url, parameters) )
         
         request = urllib.request.Request(url, data=parameters, method=method)
-                
-        if self.auth_required:
-            request.add_header("Authorization","Basic %s" % self.auth)
-        
-        try:    
-            #response = self._opener.open(request, parameters, timeout=60).read()
-            response = self._opener.open(request, timeout=60).read()
-        except URLError as e:
-            logger.error("HC2Controller.send: URLError exception reason: {0}".format(e.reason))
-        except HTTPError as e:
-            logger.error("HC2Controller.send: HTTPError exception reason: {0} code: {1}".format(e.reason, e.code))
+        # actions (callAction) are sent with GET but must not be repeated
+        idempotent = method == 'GET' and 'callAction' not in api
+        
+        try:
+            for redirect in range( max_redirects + 1 ):
+                response, body = self.__open( request, idempotent )
+                location = response.getheader( 'Location' )
+                if response.status not in ( 301, 302, 303, 307, 308 ) or location is None:
+                    break
+                url = urllib.parse.urljoin( request.full_url, location )
+                if response.status in ( 307, 308 ):
+                    request = urllib.request.Request(url, data=request.data, method=request.get_method())
+                else:
+                    request = urllib.request.Request(url, method='GET')
+            
+            if response.status >= 300:
+                logger.error("HC2Controller.send: HTTPError exception reason: {0} code: {1}".format(response.reason, response.status))
+            else:
+                self.__response_handler.handle( request.selector, response.status, body )
+                return True
         except TimeoutError as e:
             logger.error("HC2Controller.send: TimeoutError exception reason: {0}".format(e) )            
         except timeout as e:
@@ -372,8 +599,10 @@ class HC2Controller(Event, Thread):
             logger.error("HC2Controller.send: Get Address Info Error exception")
         except herror as e:
             logger.error("HC2Controller.send: Get Host Error exception")
-        else:
-            return True
+        except HTTPException as e:
+            logger.error("HC2Controller.send: HTTPException exception reason: {0}".format(repr(e)))
+        except OSError as e:
+            logger.error("HC2Controller.send: OSError exception reason: {0}".format(e))
         
         logger.debug("REQUEST: {0} {1} {2}".format(method, url, parameters) )
         logger.error("HC2Controller.send: Request has not been sent")
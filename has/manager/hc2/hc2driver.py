@@ -8,13 +8,17 @@ Generic Driver implementation and specific HC2Driver
 #from manager.driver import Driver, MsgQueueItem
 from has.manager.node import Node
 from has.utils.notification import Notification
-from has.utils.event import Wait
+from has.utils.event import Wait, WaitSet
 from has.manager.driver import MsgQueueItem
 from has.manager.driver import Driver
 from has.manager.hc2.hc2controller import HC2Controller
 from has.manager.hc2.hc2nodes import HC2Device, HC2Variable, value_types
+from has.manager.store import ValueStore
+from has.manager.cache import StateCache
+from has.manager.changelog import ChangeLog
 
 import json
+import os
 
 """"
 just for test import time
@@ -30,7 +34,11 @@ max_attempts = 0
 class HC2Driver(Driver):
     """Driver for HC2"""
     
-    def __init__(self, network, username, password, ip, port, remote=False, remote_server=None, remote_username=None, remote_password=None ):
+    def __init__(self, network, username, password, ip, port, remote=False, remote_server=None, remote_username=None, remote_password=None,
+                 batch_size=0, fetch_all_threshold=10, columnar=False, max_connections=4,
+                 history_depth=0, history_window=600, cache_file=None, cache_interval=300,
+                 changelog_dir=None, changelog_retention=90*86400, changelog_segment_records=65536,
+                 connection_idle_timeout=30 ):
         super().__init__(network)
         
         #self.url = "http://" + ip + ":" + str( port )
@@ -48,9 +56,60 @@ class HC2Driver(Driver):
         self.remote_username = remote_username
         self.remote_password = remote_password
         
+        """
+        batch_size > 0 switches the main loop to the batch mode:
+        up to batch_size rx messages and queued commands are handled per wakeup
+        """
+        self.batch_size = int(batch_size)
+        self.loop_stats = {}
+        self.loop_totals = dict( rx = 0, command = 0, refresh = 0, query = 0, notifications = 0, iterations = 0 )
+        
+        """
+        Unknown nodes reported by refreshStates waiting for the node info (node id -> monotonic time of the request).
+        More than fetch_all_threshold of them are fetched with the single request.
+        The ids are pending until the response arrives, the request fails or pending_timeout seconds pass.
+        """
+        self.fetch_all_threshold = int(fetch_all_threshold)
+        self.pending_timeout = 60.0
+        self.__pending_devices = {}
+        self.__pending_variables = {}
+        self.__fetching_all = {}    # api requesting all the nodes -> monotonic time of the request in flight
+        
+        if columnar:
+            self.value_store = ValueStore()
+        
+        """
+        Maximum number of concurrent connections used by send_msgs. The controller keeps
+        the keep-alive connections open for connection_idle_timeout seconds
+        """
+        self.max_connections = int(max_connections)
+        self.connection_idle_timeout = float(connection_idle_timeout)
+        
+        self.history_depth = int(history_depth)
+        self.history_window = float(history_window)
+        
+        """
+        Warm start: nodes, values, locations and refreshStates cursor are saved to cache_file
+        every cache_interval seconds and on exit, and loaded on start before connecting
+        """
+        self.cache = StateCache( cache_file ) if cache_file else None
+        self.cache_interval = float(cache_interval)
+        self.__cache_due = None
+        self.__cached_last_refresh = None
+        
+        """
+        Numeric value changes are appended to the change log in the network subdirectory of changelog_dir (see ChangeLog).
+        The log is opened when the driver runs
+        """
+        if changelog_dir:
+            self.changelog = ChangeLog( os.path.join( changelog_dir, str( network ) ), segment_records=int(changelog_segment_records),
+                                        retention=float(changelog_retention) )
+        
         self.all_devices_queried = False
         self.all_variables_queried = False
         
+        self.__bootstrap_started = {}     # command -> (request, monotonic time of the request)
+        
         self.__devices = set()
         self.__variables = set()
         
@@ -70,8 +129,12 @@ class HC2Driver(Driver):
         logger.info("HC2Driver.init(): Attempt {0}".format( attempt ) )
         if self.controller == None:
             self.controller = HC2Controller( self.host, self.username, self.password, self.port, 
-                                            self.remote, self.remote_server, self.remote_username, self.remote_password) 
+                                            self.remote, self.remote_server, self.remote_username, self.remote_password,
+                                            self.max_connections, self.connection_idle_timeout ) 
             logger.info("HC2Driver.Init: New controller created")
+            if self.__cached_last_refresh is not None:
+                self.controller.last_refresh = self.__cached_last_refresh
+                self.__cached_last_refresh = None
         
         if not self.controller.open(self.network_id):
             logger.error("HC2Driver.init(): Opening new controller failed")
@@ -82,13 +145,34 @@ class HC2Driver(Driver):
             
     def run(self):
         logger.info("HC2Driver.run")
+        if self.cache is not None:
+            self.load_cache()
+            self.__cache_due = time.monotonic() + self.cache_interval
+        if self.changelog is not None and not self.changelog.open():
+            self.changelog = None
+        try:
+            self.__run()
+        finally:
+            if self.cache is not None:
+                self.save_cache()
+            if self.changelog is not None:
+                self.changelog.close()
+    
+    def __run(self):
         attempt = 0
         while True:
             self.wait_objects[0] = None
             self.wait_objects[1] = None
             self.wait_objects[2] = None
             self.wait_objects[3] = None
+            self.msg_queue.reset()
             self.all_nodes_queried = False
+            self.all_devices_queried = False
+            self.all_variables_queried = False
+            self.pending_nodes.clear()
+            self.__pending_devices.clear()
+            self.__pending_variables.clear()
+            self.__fetching_all.clear()
                 
             if self.init(attempt):
                 self.running = 1
@@ -96,33 +180,42 @@ class HC2Driver(Driver):
                 self.wait_objects[0] = self.exit_event
                 self.wait_objects[1] = self.notifications_event
                 self.wait_objects[2] = self.controller
-                self.wait_objects[3] = self.queue_event[0]
-                self.wait_objects[4] = self.queue_event[1]
+                self.wait_objects[3] = self.msg_queue
                 
                 
                 #objects_number = 5
+                wait_set = WaitSet( self.wait_objects )
                 logger.info("HC2Driver.run: Running")
-                while self.running:
-                    logger.debug("HC2Driver.run: Waiting for event")
-                    res = Wait.multiple( self.wait_objects )
-                    logger.debug("HC2Driver.run: Event: {0}".format( res ) )
-                    if res == 0:
-                        logger.debug("HC2Driver.run: Exit Event")
-                        #self.Stop()
-                        return
-                    elif res == 1:
-                        logger.debug("HC2Driver.run: Notification Event")
-                        self.notify_watchers()
-                    elif res == 2:
-                        logger.debug("HC2Driver.run: Data Received")
-                        self.read_msg()
-                    elif res == -1:
-                        logger.debug("HC2Driver.run: res = -1")
-                        assert res != -1, "Wait.Multiple returned res = -1"
+                try:
+                    while self.running:
+                        logger.debug("HC2Driver.run: Waiting for event")
+                        ready = wait_set.wait( self.__cache_timeout() )
+                        if self.cache is not None and time.monotonic() >= self.__cache_due:
+                            self.save_cache()
+                        if self.batch_size > 0 and ready and ready[0] != 0:
+                            self.process_batch()
+                            continue
                         
-                    else:
-                        logger.debug("HC2Driver.run: Message Queue Event: {0}".format(res -3))
-                        self.write_next_msg(res - 3)
+                        res = ready[0] if ready else -1 # lower has higher priority
+                        logger.debug("HC2Driver.run: Event: {0}".format( res ) )
+                        if res == 0:
+                            logger.debug("HC2Driver.run: Exit Event")
+                            #self.Stop()
+                            return
+                        elif res == 1:
+                            logger.debug("HC2Driver.run: Notification Event")
+                            self.notify_watchers()
+                        elif res == 2:
+                            logger.debug("HC2Driver.run: Data Received")
+                            self.read_msg()
+                        elif res == -1:
+                            logger.debug("HC2Driver.run: res = -1")
+                            
+                        else:
+                            logger.debug("HC2Driver.run: Message Queue Event")
+                            self.write_next_msg()
+                finally:
+                    wait_set.close()
                     
         
             else:
@@ -144,55 +237,185 @@ class HC2Driver(Driver):
                         logger.error("HC2Driver.run: Exit signaled")
                         return                
     
-    def send_msg(self, queue, method, message, params=None):
+    def __cache_timeout(self):
+        """
+        Returns the time to the next periodic cache save or None if cache is not used
+        """
+        if self.cache is None:
+            return None
+        return max( 0, self.__cache_due - time.monotonic() )
+    
+    def load_cache(self):
+        """
+        Load the nodes and values from the cache file. The cached nodes are marked as stale
+        until the node info is received from the controller. The driver stays pending until
+        the controller is connected, DriverCacheLoaded is sent when loaded.
+        Returns True if loaded.
+        """
+        state = self.cache.load( self.network_id )
+        if state is None:
+            return False
+        logger.info("HC2Driver.load_cache: Loading {0} devices and {1} variables from {2}".format(
+                    len( state.get('devices', []) ), len( state.get('variables', []) ), self.cache.filename ) )
+        
+        self.locations = state.get( 'locations', [] )
+        self.serial_number = state.get( 'serial_number', self.network_id )
+        self.__cached_last_refresh = state.get( 'last_refresh' )
+        
+        stamps = state.get( 'stamps', {} )
+        self.lock_nodes()
+        try:
+            for node_info in state.get( 'devices', [] ):
+                self.__load_node( HC2Device, self.__devices, str(node_info['id']), node_info, stamps )
+            for node_info in state.get( 'variables', [] ):
+                self.__load_node( HC2Variable, self.__variables, str(node_info['name']), node_info, stamps )
+        finally:
+            self.release_nodes()
+        # the cached state is served while the driver is pending, DriverReady is sent when the controller is connected
+        self.cache_loaded = True
+        notification = Notification( Notification.Type_DriverCacheLoaded, self.network_id )
+        self.queue_notification( notification )
+        self.notify_watchers()
+        return True
+    
+    def __load_node(self, node_class, node_ids, node_id, node_info, stamps):
+        node = node_class( self.network_id, node_id, self )
+        self.nodes[node_id] = node
+        node_ids.add( node_id )
+        node.update_node_info( node_info )
+        node.stale = True
+        notification = Notification( Notification.Type_NodeAdded, self.network_id, node_id, node.node_type )
+        self.queue_notification( notification )
+        node.update_values_info()
+        for value_type, stamp in stamps.get( node_id, {} ).items():
+            value = node.get_value_by_type( value_type )
+            if value is not None:
+                value.last_changed = stamp
+    
+    def save_cache(self):
+        """
+        Save the nodes, values, locations and refreshStates cursor to the cache file
+        """
+        self.__cache_due = time.monotonic() + self.cache_interval
+        devices, variables, stamps = [], [], {}
+        self.lock_nodes_shared()
+        try:
+            for node_id, node in self.nodes.items():
+                if not node._node_info_received:
+                    continue
+                if node_id in self.__devices:
+                    devices.append( node.cache_info() )
+                elif node_id in self.__variables:
+                    variables.append( node.cache_info() )
+                stamps[node_id] = { value.value_type: value.last_changed_epoch for value in node.values() }
+        finally:
+            self.release_nodes_shared()
+        
+        controller = self.controller
+        last_refresh = controller.last_refresh if controller is not None else self.__cached_last_refresh
+        state = dict( serial_number = getattr( self, 'serial_number', self.network_id ),
+                      locations = self.locations,
+                      last_refresh = last_refresh,
+                      devices = devices,
+                      variables = variables,
+                      stamps = stamps )
+        return self.cache.save( self.network_id, state )
+    
+    def process_batch(self):
         """
-        Quiging the message to the message queue for further sending to the controller
+        Handle the pending work from all the sources in the round-robin manner.
+        Each source (controller rx queue, command, refresh and query queue) is limited
+        to batch_size items per wakeup so no source is starved.
+        All the pending notifications are delivered at the end of the iteration.
         """
-        item = MsgQueueItem()
+        budget = self.batch_size
+        counts = dict( rx = 0, command = 0, refresh = 0, query = 0 )
+        sources = ( ( 'rx', lambda: self.controller is not None and self.controller.is_set(), self.read_msg ),
+                    ( 'command', lambda: self.msg_queue.pending( Driver.MsgQueue_Command ), lambda: self.write_next_msg( Driver.MsgQueue_Command ) ),
+                    ( 'refresh', lambda: self.msg_queue.pending( Driver.MsgQueue_Refresh ), lambda: self.write_next_msg( Driver.MsgQueue_Refresh ) ),
+                    ( 'query', lambda: self.msg_queue.pending( Driver.MsgQueue_Query ), lambda: self.write_next_msg( Driver.MsgQueue_Query ) ) )
         
-        item.command = MsgQueueItem.MsgQueueCmd_SendMsg
-        item.msg = message
-        item.params = params
-        item.method = method
+        active = True
+        while active and self.running and not self.exit_event.is_set():
+            active = False
+            for name, is_pending, handler in sources:
+                if counts[name] < budget:
+                    if is_pending():
+                        handler()
+                        counts[name] += 1
+                        active = True
+                        if not self.running:  # controller reinitialization requested
+                            break
+        
+        counts['notifications'] = self.notify_watchers()
+        
+        self.loop_stats = counts
+        for name, count in counts.items():
+            self.loop_totals[name] += count
+        self.loop_totals['iterations'] += 1
+        logger.debug("HC2Driver.process_batch: rx={rx} command={command} refresh={refresh} query={query} notifications={notifications}".format( **counts ) )
+    
+    def send_msg(self, queue, method, message, params=None, ttl=None, unique=False, node_id=None):
+        """
+        Queueing the message to the message queue for further sending to the controller
+        
+        Params:
+            queue   :    Driver.MsgQueue_Command, Driver.MsgQueue_Refresh or Driver.MsgQueue_Query
+            ttl     :    message time to live in seconds (queue default if None)
+            unique  :    do not queue if the same request is already waiting in the queue
+            node_id :    node waiting for the response, notified if the message expires or is rejected
+        """
+        item = MsgQueueItem( MsgQueueItem.MsgQueueCmd_SendMsg, message, params, method, node_id = node_id )
         logger.debug( "HC2Driver.SendMsg: Queueing: {0}:{1}:{2}".format( method, message, params ) )
-        with self.send_lock:
-            self.msg_queue[queue].insert(0, item)
-            self.queue_event[queue].set()
-        logger.debug( "HC2Driver.SendMsg: Queued: {0}".format( message ) )
-
+        if self.msg_queue.put( queue, item, ttl, unique ):
+            logger.debug( "HC2Driver.SendMsg: Queued: {0}".format( message ) )
+            return True
+        self.handle_msg_failed( item )
+        return False
     
     
-    def write_next_msg(self, queue):
-        logger.debug( "HC2Driver.write_next_msg: queue: {0}".format( queue ) )
-        self.send_lock.acquire()
+    def send_msgs(self, messages):
+        """
+        Send the messages to the controller concurrently bypassing the message queue.
+        Blocks until all the messages are sent. Returns the list of results (True/False).
         
-        item = self.msg_queue[queue].pop()
-        logger.debug( "HC2Driver.write_next_msg: item: {0}".format( item.command ) )
+        Params:
+            messages:   list of (method, message, params) tuples
+        """
+        controller = self.controller
+        if controller is None or not controller.connected:
+            logger.error( "HC2Driver.send_msgs: Controller not connected" )
+            return [ False ] * len( messages )
+        logger.debug( "HC2Driver.send_msgs: Sending {0} messages".format( len( messages ) ) )
+        return controller.send_many( messages )
+    
+    
+    def write_next_msg(self, queue=None):
+        """
+        Handle the next message from the message queue (highest priority first if queue is None)
+        """
+        item = self.msg_queue.get( queue )
+        if item is None:
+            return False
+        logger.debug( "HC2Driver.write_next_msg: queue: {0} item: {1}".format( item.lane, item.command ) )
         
         if MsgQueueItem.MsgQueueCmd_SendMsg == item.command:
             self.current_message = item.msg
             self.current_params = item.params
             self.current_method = item.method
-            if len( self.msg_queue[queue] ) == 0:
-                self.queue_event[queue].clear()
-            self.send_lock.release()        
-            return self.write_msg();
+            if self.write_msg():
+                return True
+            self.handle_msg_failed( item )
+            return False
                 
         if MsgQueueItem.MsgQueueCmd_QueryStageComplete == item.command:
             self.current_message = None
-            stage = item.query_stage
-            if len( self.msg_queue[queue] ) == 0:
-                self.queue_event[queue].clear()
-            self.send_lock.release()
-            
             node = self.get_node_unsafe( item.node_id )
             if node is not None:
                 logger.info("Node {0}: Query Stage Complete ({1})".format( item.node_id, item.query_stage ) )
-                node.query_stage_complete( stage )
+                node.query_stage_complete( item.query_stage )
                 node.advance_queries()
                 return True
-    
-        self.send_lock.release()
         
         return False
     
@@ -216,9 +439,15 @@ class HC2Driver(Driver):
         """
         Read the message from the comntroller and call the handler
         """
-        command, parameters, response  = self.controller.receive()
+        message = self.controller.receive()
+        if message is None:
+            return
+        command, parameters, response = message
         try:
-            return self.__handlers[command](command, parameters, response)
+            result = self.__handlers[command](command, parameters, response)
+            if self.__bootstrap_started:
+                self.__bootstrap_response( command, parameters )
+            return result
         except KeyError:
             logger.error( "HC2Driver: Unhandled response: command={0}, parameters={1}, response={2}".format( command, parameters, response ) )
             return
@@ -230,8 +459,7 @@ class HC2Driver(Driver):
     def __handle_error_response( self, command, parameters, response ):
         logger.error( "HC2Driver: Controller error reported. Reinitializing the controller" )
         self.running = False
-        del self.notifications
-        self.notifications = []
+        self.notifications.clear()
         self.controller.running = False
         self.controller.close()
         del self.controller
@@ -257,43 +485,49 @@ class HC2Driver(Driver):
             response contains all devices information
             """
             all_nodes = True   
+            self.__pending_devices.clear()
+            self.__fetching_all.pop( "/api/devices", None )
             
-        new_nodes = set()    
-        for node_info in nodes:
-            node_id = str(node_info['id'])
+        new_nodes = set()
+        self.lock_nodes()   # once for the whole response
+        try:
+            for node_info in nodes:
+                node_id = str(node_info['id'])
+                self.__pending_devices.pop( node_id, None )
+                if all_nodes:
+                    new_nodes.add(node_id)
+                
+                node = self.nodes.get( node_id ) if node_id in self.__devices else None
+                if node is not None:
+                    logger.debug('Node {0}: Updated'.format(node_id)) 
+                    node.update_node_info(node_info)
+                else:
+                    logger.debug('Node {0}: Added'.format(node_id)) 
+                    self.__devices.add( node_id )
+                    node = self.nodes[node_id] = HC2Device(self.network_id, node_id, self)
+                    node.update_node_info(node_info)
+                    notification = Notification( Notification.Type_NodeAdded, self.network_id, node_id, node.node_type )
+                    self.queue_notification( notification )
+                
+                if node.query_stage != Node.QueryStage_Complete:   # advanced here, not through the message queue
+                    node.query_stage_complete( Node.QueryStage_NodeInfo )
+                    node.advance_queries()
             
             if all_nodes:
-                new_nodes.add(node_id)
-            
-            if node_id in self.__devices:
-                logger.debug('Node {0}: Updated'.format(node_id)) 
-                self.nodes[node_id].update_node_info(node_info)                
-            else:
-                logger.debug('Node {0}: Added'.format(node_id)) 
-                self.lock_nodes()
-                self.__devices.add( node_id )
-                self.nodes[node_id] = HC2Device(self.network_id, node_id)                
-                self.nodes[node_id].update_node_info(node_info)
-                self.release_nodes()
-                notification = Notification( Notification.Type_NodeAdded )
-                notification.node_id = node_id
-                notification.network_id = self.network_id
-                self.queue_notification( notification )
-            
-            #self.nodes[node_id].set_query_stage( Node.QueryStage_NodeValues, True )
-            self.send_query_stage_complete(node_id, Node.QueryStage_NodeInfo )
+                missing_nodes = self.__devices - new_nodes
+                for node_id in missing_nodes:
+                    self.__devices.discard( node_id )
+                    self.pending_nodes.discard( node_id )
+                    logger.debug('Node {0}: Removed'.format(node_id)) 
+                    self.nodes.pop(node_id).release_values()
+                    notification = Notification( Notification.Type_NodeRemoved, self.network_id, node_id )
+                    self.queue_notification( notification )
+        finally:
+            self.release_nodes()
         
         if all_nodes:
-            missing_nodes = self.__devices - new_nodes
-            for node_id in missing_nodes:
-                logger.debug('Node {0}: Removed'.format(node_id)) 
-                self.lock_nodes()
-                del self.nodes[node_id]
-                self.release_nodes()
-                notification = Notification( Notification.Type_NodeRemoved )
-                notification.node_id = node_id
-                notification.network_id = self.network_id
-                self.queue_notification( notification )
+            self.all_devices_queried = True
+            self.check_completed_node_queries()
         return
     
     def __handle_global_variables_response( self, command, parameters, response ):
@@ -314,40 +548,49 @@ class HC2Driver(Driver):
             response contains all devices information
             """
             all_nodes = True   
+            self.__pending_variables.clear()
+            self.__fetching_all.pop( "/api/globalVariables", None )
             
-        new_nodes = set()    
-        for node_info in nodes:
-            node_id = str(node_info['name'])
-            if all_nodes:
-                new_nodes.add(node_id)
+        new_nodes = set()
+        self.lock_nodes()   # once for the whole response
+        try:
+            for node_info in nodes:
+                node_id = str(node_info['name'])
+                self.__pending_variables.pop( node_id, None )
+                if all_nodes:
+                    new_nodes.add(node_id)
+                
+                node = self.nodes.get( node_id ) if node_id in self.__variables else None
+                if node is not None:
+                    logger.debug('Variable {0}: Updated'.format(node_id)) 
+                    node.update_node_info(node_info)
+                else:
+                    logger.debug('Variable {0}: Added'.format(node_id)) 
+                    self.__variables.add( node_id )
+                    node = self.nodes[node_id] = HC2Variable(self.network_id, node_id, self)
+                    node.update_node_info(node_info)
+                    notification = Notification( Notification.Type_NodeAdded, self.network_id, node_id, node.node_type )
+                    self.queue_notification( notification )
+                
+                if node.query_stage != Node.QueryStage_Complete:   # advanced here, not through the message queue
+                    node.query_stage_complete( Node.QueryStage_NodeInfo )
+                    node.advance_queries()
             
-            if node_id in self.__variables:
-                logger.debug('Variable {0}: Updated'.format(node_id)) 
-                self.nodes[node_id].update_node_info(node_info)
-            else:
-                logger.debug('Variable {0}: Added'.format(node_id)) 
-                self.lock_nodes()
-                self.__variables.add( node_id )
-                self.nodes[node_id] = HC2Variable(self.network_id, node_id)                
-                self.nodes[node_id].update_node_info(node_info)
-                self.release_nodes()
-                notification = Notification( Notification.Type_NodeAdded )
-                notification.node_id = node_id
-                notification.network_id = self.network_id
-                self.queue_notification( notification )
-            self.send_query_stage_complete(node_id, Node.QueryStage_NodeInfo )
+            if all_nodes:
+                missing_nodes = self.__variables - new_nodes
+                for node_id in missing_nodes:
+                    self.__variables.discard( node_id )
+                    self.pending_nodes.discard( node_id )
+                    logger.debug('Variable {0}: Removed'.format(node_id)) 
+                    self.nodes.pop(node_id).release_values()
+                    notification = Notification( Notification.Type_NodeRemoved, self.network_id, node_id )
+                    self.queue_notification( notification )
+        finally:
+            self.release_nodes()
         
         if all_nodes:
-            missing_nodes = self.__variables - new_nodes
-            for node_id in missing_nodes:
-                logger.debug('Variable {0}: Removed'.format(node_id)) 
-                self.lock_nodes()
-                del self.nodes[node_id]
-                self.release_nodes()
-                notification = Notification( Notification.Type_NodeRemoved )
-                notification.node_id = node_id
-                notification.network_id = self.network_id
-                self.queue_notification( notification )
+            self.all_variables_queried = True
+            self.check_completed_node_queries()
         return
         
         
@@ -376,6 +619,8 @@ class HC2Driver(Driver):
         status = content['status']
         if status == "IDLE":
             timestamp = content['timestamp']
+            unknown_devices = set()
+            unknown_variables = set()
             if 'changes' in content.keys():
                 changes = content['changes']
                 for change in changes:
@@ -405,21 +650,25 @@ class HC2Driver(Driver):
                                         self.release_nodes()
                                     else:
                                         logger.debug("Node {0}: Refresh for non existing variable".format( name ) )
-                                        self.send_msg( Driver.MsgQueue_Command, "GET", "/api/globalVariables?name={0}".format( name ) )
+                                        unknown_variables.add( name )
                                     
-                        for value_type in value_types:
-                            if value_type in change.keys():
-                                node = self.get_node(node_id)
-                                if node is not None: 
-                                    if node._node_info_received:
+                        changed_types = [ value_type for value_type in value_types if value_type in change ]
+                        if changed_types:
+                            node = self.get_node(node_id)
+                            if node is not None: 
+                                if node._node_info_received:
+                                    for value_type in changed_types:
                                         node.update_value( value_type, str(change[value_type]) )
-                                    else:
-                                        logger.debug("Node {0}: Refresh but node info not received. Refresh skipped" % node_id)
-                                    self.release_nodes()
                                 else:
-                                    logger.debug("Node {0}: Refresh for non existing node".format( node_id) )
-                                    self.send_msg( Driver.MsgQueue_Command,  "GET", "/api/devices?id={0}".format(node_id))
-                                    #self.init_node(node_id)
+                                    logger.debug("Node {0}: Refresh but node info not received. Refresh skipped".format( node_id ) )
+                                self.release_nodes()
+                            else:
+                                logger.debug("Node {0}: Refresh for non existing node".format( node_id) )
+                                unknown_devices.add( node_id )
+                                #self.init_node(node_id)
+            
+            self.__request_unknown_nodes( self.__pending_devices, unknown_devices, "/api/devices", "/api/devices?id={0}" )
+            self.__request_unknown_nodes( self.__pending_variables, unknown_variables, "/api/globalVariables", "/api/globalVariables?name={0}" )
             
         elif status in ['ZWAVE_LEARN_MODE_ADDING','ZWAVE_LEARN_MODE_REMOVING']:
             logger.debug("HC2Driver.handle_refresh_states: {0}".format( status ) )
@@ -430,6 +679,65 @@ class HC2Driver(Driver):
         
         return
     
+    def __request_unknown_nodes( self, pending, node_ids, api_all, api_node ):
+        """
+        Request the information about the nodes unknown to the driver.
+        The requests queued or in flight are not repeated and nothing is requested
+        while the request for all the nodes is in flight. When more than
+        fetch_all_threshold nodes are pending the individual requests are replaced
+        with the single request for all the nodes.
+        
+        Params:
+            pending     :    dict of node ids already requested -> monotonic time of the request
+            node_ids    :    set of unknown node ids
+            api_all     :    url requesting all the nodes
+            api_node    :    url format requesting the single node
+        """
+        now = time.monotonic()
+        expired = [ node_id for node_id, requested in pending.items() if now - requested > self.pending_timeout ]
+        for node_id in expired:
+            del pending[node_id]
+        requested = self.__fetching_all.get( api_all )
+        if requested is not None and now - requested > self.pending_timeout:
+            del self.__fetching_all[api_all]
+            requested = None
+        
+        new_nodes = node_ids - pending.keys()
+        if not new_nodes:
+            return
+        for node_id in new_nodes:
+            pending[node_id] = now
+        
+        if requested is not None:
+            logger.debug("HC2Driver.request_unknown_nodes: {0} in flight. {1} nodes pending".format( api_all, len( pending ) ) )
+            return
+        
+        if len( pending ) > self.fetch_all_threshold:
+            logger.debug("HC2Driver.request_unknown_nodes: {0} nodes pending. Requesting {1}".format( len( pending ), api_all ) )
+            for node_id in pending:
+                self.msg_queue.discard( "GET", api_node.format( node_id ) )
+            self.__fetching_all[api_all] = now
+            self.send_msg( Driver.MsgQueue_Refresh, "GET", api_all, unique=True )
+        else:
+            for node_id in new_nodes:
+                self.send_msg( Driver.MsgQueue_Refresh, "GET", api_node.format( node_id ), unique=True )
+    
+    def handle_msg_failed(self, item):
+        """
+        The nodes requested by the failed, expired or rejected message are no longer pending,
+        so they are requested again with the next refresh
+        """
+        super().handle_msg_failed( item )
+        if item.command != MsgQueueItem.MsgQueueCmd_SendMsg:
+            return
+        for api_all, api_node, pending in ( ( "/api/devices", "/api/devices?id=", self.__pending_devices ),
+                                            ( "/api/globalVariables", "/api/globalVariables?name=", self.__pending_variables ) ):
+            if item.msg == api_all:
+                self.__fetching_all.pop( api_all, None )
+                pending.clear()
+            elif item.msg.startswith( api_node ):
+                pending.pop( item.msg[len( api_node ):], None )
+    
     def __handle_settings_info_response( self, command, parameters, response ):
         logger.debug( "HC2Driver.HandleSettingsInfoResponse: response={0}".format( response ) )
         try:
@@ -459,18 +767,40 @@ class HC2Driver(Driver):
     
     def handle_all_nodes_queried(self):
         logger.debug("HC2Driver.handle_all_nodes_queried. Requesting: /api/refreshStates")
-        self.send_msg( Driver.MsgQueue_Command,  "GET", "/api/refreshStates")
+        self.send_msg( Driver.MsgQueue_Refresh,  "GET", "/api/refreshStates")
 
     
+    def initial_nodes_received(self):
+        return self.all_devices_queried and self.all_variables_queried
+    
     def request_initial_data(self):
-        logger.debug("HC2Driver.get_initial_data: /api/rooms")
-        self.send_msg( Driver.MsgQueue_Command,  "GET", "/api/rooms" )
-        
-        logger.debug("HC2Driver.get_initial_data: /api/devices")
-        self.send_msg( Driver.MsgQueue_Command,  "GET", "/api/devices")
-        
-        logger.debug("HC2Driver.get_initial_data: /api/globalVariables")
-        self.send_msg( Driver.MsgQueue_Command,  "GET", "/api/globalVariables")
+        """
+        Request rooms, devices and global variables concurrently (see HC2Controller.send_async).
+        Responses are handled as they arrive, the time from the request
+        to the handled response is kept in bootstrap_times.
+        """
+        requests = [ ( "GET", "/api/rooms", None ),
+                     ( "GET", "/api/devices", None ),
+                     ( "GET", "/api/globalVariables", None ) ]
+        started = time.monotonic()
+        self.bootstrap_times = {}
+        self.__bootstrap_started = {}
+        for method, api, params in requests:
+            logger.debug("HC2Driver.get_initial_data: {0}".format( api ) )
+            self.__bootstrap_started[ api[1:].replace( '/', '_' ) ] = ( api, started )
+        self.__fetching_all["/api/devices"] = started
+        self.__fetching_all["/api/globalVariables"] = started
+        self.controller.send_async( requests )
+    
+    def __bootstrap_response(self, command, parameters):
+        """
+        Record the time of the handled bootstrap response
+        """
+        if parameters or command not in self.__bootstrap_started:
+            return
+        api, started = self.__bootstrap_started.pop( command )
+        self.bootstrap_times[api] = time.monotonic() - started
+        logger.info("HC2Driver.request_initial_data: {0} handled in {1:.3f}s".format( api, self.bootstrap_times[api] ) )
             
     def get_location_name(self, location_id):
         if location_id == 0:
@@ -483,25 +813,25 @@ class HC2Driver(Driver):
         
     def is_node_light( self, node_id ):
         res = False
-        node = self.get_node( node_id )
+        node = self.get_node_shared( node_id )
         if node:
             res = node.is_light
-            self.release_nodes()
+            self.release_nodes_shared()
         return res
         
     def is_node_dead( self, node_id ):
         res = False
-        node = self.get_node( node_id )
+        node = self.get_node_shared( node_id )
         if node:
             res = node.is_dead
-            self.release_nodes()
+            self.release_nodes_shared()
         return res
     
     
     def is_node_battery_operated( self, node_id ):
         res = False
-        node = self.get_node( node_id )
+        node = self.get_node_shared( node_id )
         if node:
             res = node.is_battery_operated
-            self.release_nodes()
+            self.release_nodes_shared()
         return res
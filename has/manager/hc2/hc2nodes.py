@@ -10,12 +10,27 @@ import logging
 #import has.manager
 from has.manager.node import Node
 from has.manager.value import Value, OnOffValue, OpenCloseValue,TimeStampValue
+from has.manager.value import number_codec, epoch_codec, bool_codec, text_codec
 
 
 value_types = ( "sunriseHour", "sunsetHour", "dead", "valueSensor", "valueMeter", "value", 
                 "batteryLevel", "armed", "lastBreached", "color", "currentProgram",
                 "lastColorSet", "lastUsedPrograms", "modified","created", "nextDrenching", "mode" )
 value_types_rw = ( "value", "armed" )
+value_types_set = frozenset( value_types )
+
+"""
+Native type of the device values (see ValueCodec), not listed are kept as strings
+"""
+value_codecs = dict( value = number_codec, valueSensor = number_codec, valueMeter = number_codec,
+                     batteryLevel = number_codec, dead = bool_codec, armed = bool_codec,
+                     lastBreached = epoch_codec, modified = epoch_codec, created = epoch_codec )
+
+"""
+Value schema cache shared by all the devices:
+(node_type, value types present) -> tuple of (value_type, value_class, units_attribute, default_units)
+"""
+value_schemas = {}
 
 import logging
 logger = logging.getLogger('manager')
@@ -23,25 +38,42 @@ import json
 
 
 class HC2Device(Node):
+    """
+    HC2 device node. Node info attributes and properties are flattened to the _view dictionary
+    when node info is updated, so attributes are resolved with the single dict read.
+    """
+    _view = {}              # flattened node info: properties overridden by top level attributes
+    _nested = frozenset()   # top level attributes being the dictionaries (i.e. properties)
 
+    def update_node_info(self, node_info):
+        self.__build_view( node_info )
+        super().update_node_info( node_info )
+    
+    def __build_view(self, node_info):
+        view = {}
+        properties = node_info.get( 'properties' )
+        if isinstance( properties, dict ):
+            view.update( properties )
+        nested = set()
+        for name, attr in node_info.items():
+            if isinstance( attr, dict ):
+                nested.add( name )
+                view.pop( name, None )
+            else:
+                view[name] = attr
+        self._view = view
+        self._nested = frozenset( nested )
+    
     @property
     def name(self):
-        if self._node_info is not None:
-            try:
-                return self._node_info['name']
-            except:
-                pass
-        return ""    
+        return self._view.get( 'name', "" )
     
 
     @property
     def location(self):
         """ Physical node location id property """
         if self._node_info is not None:
-            try:
-                return self._node_info['roomID']
-            except:
-                return None        #TODO: Ignorance is not bliss
+            return self._node_info.get( 'roomID' )   #TODO: Ignorance is not bliss
         return ""
 
     @property
@@ -57,13 +89,7 @@ class HC2Device(Node):
         
     @property
     def node_type(self):
-        if self._node_info is not None:
-            try:
-                return self._node_info['type']
-            except Exception as e:
-                print("Exception in HC2Device:node_type: %s"  % e )
-                pass
-        return None
+        return self._view.get( 'type' )
     
     @property 
     def units(self):   #### TODO: handle missing units
@@ -85,21 +111,12 @@ class HC2Device(Node):
                 pass
     
     def __getattr__(self, name):
-        try:
-            attr = self._node_info[name]
-            if isinstance( attr, dict):
-                return self
-            else:
-                return attr            
-        except:
-            pass
-            #logger.debug("Node:__getattr__: missing or invalid attribute:  %s" % name)
-            #print("Node:__getattr__: missing or invalid attribute:  %s" % name)
-            
-        try:
-            return self._node_info['properties'][name]
-        except:
-            raise AttributeError  # Used by hasattrib
+        view = self._view
+        if name in view:
+            return view[name]
+        if name in self._nested:
+            return self
+        raise AttributeError( name )  # Used by hasattrib
             
             
     @property
@@ -114,114 +131,155 @@ class HC2Device(Node):
     
     @property
     def is_dead(self):
-        res = False
-        if self._node_info is not None:
-            try:
-                properties = self._node_info['properties']
-                if properties['dead'] != "0":
-                    res = True
-            except:
-                res = False #TODO: Ignorance is not bliss
-        return res
+        return self.__property( 'dead', "0" ) != "0"
         
     @property
     def is_light(self):
-        res = False
-        if self._node_info is not None:
-            try:
-                properties = self._node_info['properties']
-                #print "node %s, deviceControlType %s" % (self.id, self.properties.deviceControlType)
-                if properties['deviceControlType'] in ("2", "23"):
-                    res = True
-            except:
-                res = False
-        
-        return res    
+        return self.__property( 'deviceControlType' ) in ("2", "23")
     
     @property
     def is_battery_operated(self):
-        res = False
-        if self._node_info is not None:
-            try:
-                properties = self._node_info['properties']
-                if properties['isBatteryOperated'] == '1':
-                    res = True
-            except:
-                res = False
-        return res    
+        return self.__property( 'isBatteryOperated' ) == '1'
+    
+    def __property(self, name, default=None):
+        properties = self._node_info.get( 'properties' ) if self._node_info is not None else None
+        if isinstance( properties, dict ):
+            return properties.get( name, default )
+        return default
+    
+    def value_types_changed(self):
+        return value_types_set.intersection( self._view ) != set( self.value_types() )
+    
+    def cache_info(self):
+        """
+        Returns the copy of the node info with the current values (used by the state cache)
+        """
+        node_info = dict( self._node_info )
+        properties = dict( node_info.get( 'properties' ) or {} )
+        for value in self.values():
+            value_type = value.value_type
+            if value_type in node_info and not isinstance( node_info[value_type], dict ):
+                node_info[value_type] = value.get()
+            else:
+                properties[value_type] = value.get()
+        node_info['properties'] = properties
+        return node_info
+    
+    def value_schema(self):
+        """
+        Returns the tuple of (value_type, value_class, units_attribute, default_units) for the values
+        present in the node info. Schema is cached per node type and set of value types present.
+        """
+        node_type = self.node_type
+        present = value_types_set.intersection( self._view )
+        key = ( node_type, frozenset( present ) )
+        schema = value_schemas.get( key )
+        if schema is None:
+            fix_units = '' # patch until fibaro fix it TODO: update getter for unists
+            if node_type == 'dimmable_light':
+                fix_units = "%"
+            elif node_type == 'thermostat_setpoint':
+                fix_units = "C"
+            schema = []
+            for value_type in value_types:
+                if value_type in present:
+                    units_attribute, default_units = None, ''
+                    if value_type == 'valueMeter':
+                        units_attribute = 'unitMeter'
+                    elif value_type == 'valueSensor':
+                        units_attribute = 'unitSensor'
+                    elif value_type == 'value':
+                        units_attribute, default_units = 'unit', fix_units
+                    schema.append( ( value_type, self.value_class( node_type, value_type ), units_attribute, default_units ) )
+            schema = tuple( schema )
+            value_schemas[key] = schema
+        return schema
+    
+    @staticmethod
+    def value_class(node_type, value_type):
+        if value_type in ("lastBreached","modified","created"):
+            return TimeStampValue
+        elif value_type == 'value':
+            if node_type == "binary_light":
+                return OnOffValue
+            elif node_type in ("door_sensor","window_sensor"):
+                return OpenCloseValue
+        return Value
     
     
     def query_node_info(self):
+        driver = self.driver
+        if self._node_info_received and not driver.all_devices_queried:
+            logger.debug("Node {0}: Device Info comes with all devices response".format( self._node_id ) )
+            return
         logger.info("Node {0}: Query for Device Info".format( self._node_id ) )
-        self.driver.send_msg(0, "GET", "/api/devices?id={0}".format( self._node_id ) ) # command queue
+        driver.send_msg(driver.MsgQueue_Query, "GET", "/api/devices?id={0}".format( self._node_id ), unique=True, node_id=self._node_id )
             
 
     def update_values_info(self):
         logger.debug("Node {0}: values_info_received={1}".format( self._node_id, self._values_info_received ) )
         if self._node_info_received:
-            fix_units = '' # patch until fibaro fix it TODO: update getter for unists
-            if self.units == "": 
-                if self.node_type == 'dimmable_light':
-                    fix_units = "%"
-                elif self.node_type == 'thermostat_setpoint':
-                    fix_units = "C"
-            for attr in value_types:
-                if hasattr(self, attr):
-                    units = ''    # reset
-                    if attr == 'valueMeter':
-                        units = self.unitMeter
-                    elif attr == 'valueSensor':
-                        units = self.unitSensor
-                    elif attr == 'value':
-                        units = self.units if self.units != "" else fix_units
+            view = self._view
+            schema = self.value_schema()
+            for attr, value_class, units_attribute, default_units in schema:
+                if self.get_value_by_type( attr ) is not None:
+                    logger.debug("Node {0}: Name {1} update value {2}".format( self._node_id, self.name, attr) )
+                    self.update_value( attr, str( view[attr] ) )
                     
-                    
-                    value_id = self.create_value_id( attr )
-                    if self.get_value( value_id ) is not None:
-                        logger.debug("Node {0}: Name {1} update value {2}".format( self._node_id, self.name, attr) )
-                        self.update_value(attr, getattr(self, attr) )
-                        
-                    else: 
-                        logger.debug("Node {0}: Name {1} create value {2}".format( self._node_id, self.name, attr) )
-                        self.create_value( attr, getattr(self, attr), units )
+                else: 
+                    logger.debug("Node {0}: Name {1} create value {2}".format( self._node_id, self.name, attr) )
+                    units = view.get( units_attribute, '' ) if units_attribute is not None else ''
+                    if units == '':
+                        units = default_units
+                    self.create_value( attr, view[attr], units, value_class )
+            
+            if len( schema ) != len( self.value_types() ):
+                present = set( entry[0] for entry in schema )
+                for value_type in self.value_types():
+                    if value_type not in present:
+                        logger.debug("Node {0}: Name {1} remove value {2}".format( self._node_id, self.name, value_type) )
+                        self.remove_value( value_type )
                     
         
         self._values_info_received = True  
        
         
     def set_value(self, value_id, value):  #TODO: Add variable set  - delegate to Value obj - virtualize
-        assert self.node_type != "unknown", "Unknown device type"
-        send = False
+        command = self.get_set_command( value_id, value )
+        if command is not None:
+            method, message, params = command
+            self.driver.send_msg(self.driver.MsgQueue_Command, method, message, params )
+        
+    def get_set_command(self, value_id, value):
+        """
+        Returns the (method, message, params) command setting the value
+        or None if the value can not be set (unknown device type or value type)
+        """
+        if self.node_type in ( None, "unknown" ):
+            logger.error("Node {0}: Set value {1} of unknown device type not supported".format( self._node_id, value_id.value_type ) )
+            return None
         value_type = value_id.value_type
         if value_type == "value":
-            command = "/api/callAction?deviceID={0}&name=setValue&arg1={1}".format( self._node_id, value )
-            send = True
+            return 'GET', "/api/callAction?deviceID={0}&name=setValue&arg1={1}".format( self._node_id, value ), None
     
         elif value_type == "armed":
-            command = "/api/callAction?deviceID={0}&name=setArmed&arg1={1}".format( self._node_id, value )
-            send = True
+            return 'GET', "/api/callAction?deviceID={0}&name=setArmed&arg1={1}".format( self._node_id, value ), None
         
-        if send:
-            self.driver.send_msg(0, 'GET', command ) #Driver.MsgQueue_Command
+        return None
         
 
 
 
-    def create_value(self, value_type, value, units=""): 
+    def create_value(self, value_type, value, units="", value_class=None): 
         logger.debug("Node {0}: Create value: {1}".format( self._node_id, value_type ) )
-        if value_type in ("lastBreached","modified","created"):
-            value_obj = TimeStampValue( self._network_id, self._node_id, value_type, str(value), "")
-        elif value_type == 'value':
-            if self.node_type == "binary_light":
-                value_obj = OnOffValue( self._network_id, self._node_id, value_type, str(value), "")
-            elif self.node_type in ("door_sensor","window_sensor"):
-                value_obj = OpenCloseValue( self._network_id, self._node_id, value_type, str(value), "")
-            else:
-                value_obj = Value( self._network_id, self._node_id, value_type, str(value), units )
-        else:        
-            value_obj = Value( self._network_id, self._node_id, value_type, str(value), units)
+        if value_class is None:
+            value_class = self.value_class( self.node_type, value_type )
+        if value_class is not Value:
+            units = ""
+        value_obj = value_class( self._network_id, self._node_id, value_type, str(value), units,
+                                 value_codecs.get( value_type, text_codec ) )
         
-        ro = getattr(self, 'readOnly', True)
+        ro = self._view.get('readOnly', True)
         
         if (value_type in value_types_rw) or (ro is False):
             value_obj.is_read_only = False
@@ -236,8 +294,8 @@ class HC2Device(Node):
 #------------------------------- VariableNode
 class HC2Variable(Node):
     
-    def __init__(self, network_id, node_id):
-        super().__init__(network_id, node_id)
+    def __init__(self, network_id, node_id, driver=None):
+        super().__init__(network_id, node_id, driver)
         self.__units == ""
         
 
@@ -284,6 +342,16 @@ class HC2Variable(Node):
             #return super().__getattr__(name)
                         
             
+    def cache_info(self):
+        """
+        Returns the copy of the node info with the current value (used by the state cache)
+        """
+        node_info = dict( self._node_info )
+        value = self.get_value_by_type( 'value' )
+        if value is not None:
+            node_info['value'] = value.get()
+        return node_info
+    
     @property
     def description(self):
         return "variable"
@@ -300,8 +368,12 @@ class HC2Variable(Node):
         return False
         
     def query_node_info(self):
+        driver = self.driver
+        if self._node_info_received and not driver.all_variables_queried:
+            logger.debug("Node {0}: Variable Info comes with all variables response".format( self._node_id ) )
+            return
         logger.info("Node {0}: Query for Variable Info".format( self._node_id ) )
-        self.driver.send_msg(0, 'GET', "/api/globalVariables?name=%s" % self._node_id) # command queue
+        driver.send_msg(driver.MsgQueue_Query, 'GET', "/api/globalVariables?name=%s" % self._node_id, unique=True, node_id=self._node_id )
         
 
     def update_values_info(self):
@@ -309,8 +381,7 @@ class HC2Variable(Node):
         if self._node_info_received:
             self._node_info['type'] = "variable"
             self._node_info['unit'] = ""
-            value_id = self.create_value_id( 'value' )
-            if self.get_value( value_id ) is not None:
+            if self.get_value_by_type( 'value' ) is not None:
                 logger.debug("Node {0}: Name {1} update value {2}".format( self._node_id, self.name, 'value') )
                 self.update_value( 'value', str(self._node_info['value'] ) )
             else: 
@@ -321,16 +392,27 @@ class HC2Variable(Node):
         self._values_info_received = True 
       
     def set_value(self, value_id, value):
-        assert self.node_type == "variable", "Expected node_type to be variable"
-        send = False
+        command = self.get_set_command( value_id, value )
+        if command is not None:
+            method, message, params = command
+            self.driver.send_msg(self.driver.MsgQueue_Command, method, message, params)
+        #self.driver.send_msg(0, "/api/globalVariables?name=%s" % self._node_id) # command queue
+        
+    def get_set_command(self, value_id, value):
+        """
+        Returns the (method, message, params) command setting the variable
+        or None if the node is not a variable
+        """
+        if self.node_type != "variable":
+            logger.error("Node {0}: Set value {1} of node type {2} not supported".format( self._node_id, value_id.value_type, self.node_type ) )
+            return None
         value_type = value_id.value_type
         command = "/api/globalVariables"
         params = {}
         params['name'] = self._node_id
         params[value_type] = value
         params = json.dumps(params)
-        self.driver.send_msg(0, 'PUT', command, params) #Driver.MsgQueue_Command
-        #self.driver.send_msg(0, "/api/globalVariables?name=%s" % self._node_id) # command queue
+        return 'PUT', command, params
         
         
     def create_value(self, value_type, value, units=""):
@@ -0,0 +1,181 @@
+# Copyright (c) Klaudisz Staniek.
+# See LICENSE for details.
+
+"""
+Value history implementation
+
+"""
+
+from array import array
+from collections import deque
+from time import time, monotonic
+
+import logging
+logger = logging.getLogger('manager')
+
+
+NaN = float('nan')
+
+
+class ValueHistory(object):
+    """
+    Bounded history of the value changes.
+    The (monotonic, epoch, number) entries are kept in the ring buffer of three arrays with the fixed depth.
+    Values which are not numbers are stored as NaN.
+    The window and the searches use the monotonic timestamps, so the wall clock changes
+    do not reorder the entries. The epoch is kept for display only.
+
+    Minimum, maximum and mean over the sliding time window are maintained on each add
+    (monotonic deques and the running sum), so window_stats costs O(1) amortized.
+    The entries expired by window_stats since the last add are remembered in the read-side
+    tuple replaced as a whole, so the concurrent readers do not modify the window and the repeated
+    reads do not walk the same entries again.
+    """
+    __slots__ = ( 'depth', 'window', '__stamps', '__epochs', '__numbers', '__seq',
+                  '__start', '__min', '__max', '__sum', '__count', '__expired' )
+
+    def __init__(self, depth, window):
+        """
+        Params:
+            depth   :    maximum number of the entries kept
+            window  :    length of the statistics window in seconds
+        """
+        self.depth = depth
+        self.window = window
+        self.__stamps = array('d', [0.0]) * depth     # monotonic
+        self.__epochs = array('d', [0.0]) * depth
+        self.__numbers = array('d', [NaN]) * depth
+        self.__seq = 0          # sequence number of the next entry
+        self.__start = 0        # sequence number of the oldest entry in the window
+        self.__min = deque()    # sequence numbers with increasing values
+        self.__max = deque()    # sequence numbers with decreasing values
+        self.__sum = 0.0
+        self.__count = 0        # number of the entries in the window being numbers
+        self.__expired = None   # read-side expiry: (window start, limit, start, expired sum, expired count)
+
+    def __len__(self):
+        return min( self.__seq, self.depth )
+
+    @staticmethod
+    def __to_number(value):
+        try:
+            return float( value )
+        except ( TypeError, ValueError ):
+            return NaN
+
+    def add(self, epoch, stamp, value):
+        """
+        Append the value to the history
+
+        Params:
+            epoch   :    epoch timestamp
+            stamp   :    monotonic timestamp
+            value   :    value (converted to float, NaN if not a number)
+        """
+        number = self.__to_number( value )
+        seq = self.__seq
+        if seq - self.depth >= self.__start:
+            self.__evict( seq - self.depth + 1 )   # oldest entry is overwritten
+        
+        index = seq % self.depth
+        self.__stamps[index] = stamp
+        self.__epochs[index] = epoch
+        self.__numbers[index] = number
+        self.__seq = seq + 1
+
+        if number == number:   # not NaN
+            self.__sum += number
+            self.__count += 1
+            numbers = self.__numbers
+            depth = self.depth
+            minimum = self.__min
+            while minimum and numbers[ minimum[-1] % depth ] >= number:
+                minimum.pop()
+            minimum.append( seq )
+            maximum = self.__max
+            while maximum and numbers[ maximum[-1] % depth ] <= number:
+                maximum.pop()
+            maximum.append( seq )
+
+        self.__expire( stamp )
+
+    def __expire(self, now):
+        """
+        Remove the entries older than the window from the statistics
+        """
+        limit = now - self.window
+        end = self.__start
+        while end < self.__seq and self.__stamps[ end % self.depth ] < limit:
+            end += 1
+        if end > self.__start:
+            self.__evict( end )
+
+    def __evict(self, end):
+        """
+        Remove the entries from the window start up to end (exclusive) from the statistics
+        """
+        numbers = self.__numbers
+        for seq in range( self.__start, end ):
+            number = numbers[ seq % self.depth ]
+            if number == number:
+                self.__sum -= number
+                self.__count -= 1
+        self.__start = end
+        while self.__min and self.__min[0] < end:
+            self.__min.popleft()
+        while self.__max and self.__max[0] < end:
+            self.__max.popleft()
+
+    def since(self, epoch=0):
+        """
+        Returns the list of (epoch, number) tuples not older than epoch, oldest first.
+        The epoch is converted to the monotonic time with the current clocks offset
+        """
+        stamp = monotonic() - ( time() - epoch )
+        stamps = self.__stamps
+        depth = self.depth
+        low, high = max( 0, self.__seq - depth ), self.__seq
+        while low < high:   # binary search of the first entry not older than stamp
+            middle = ( low + high ) // 2
+            if stamps[ middle % depth ] < stamp:
+                low = middle + 1
+            else:
+                high = middle
+        return [ ( self.__epochs[ seq % depth ], self.__numbers[ seq % depth ] ) for seq in range( low, self.__seq ) ]
+
+    def window_stats(self, now=None):
+        """
+        Returns the dictionary with count, min, max and mean of the numbers in the window
+        (min, max and mean are None if there is no number in the window). The window is not modified,
+        so the readers can call it concurrently.
+
+        Params:
+            now     :    monotonic timestamp the window ends at, time of the last entry if None
+        """
+        depth = self.depth
+        numbers = self.__numbers
+        total, count, start = self.__sum, self.__count, self.__start
+        if now is not None:
+            limit = now - self.window
+            expired_sum, expired_count = 0.0, 0
+            expired = self.__expired
+            window_start = start
+            if expired is not None and expired[0] == window_start and expired[1] <= limit:
+                start, expired_sum, expired_count = expired[2:]   # continue where the last read stopped
+            while start < self.__seq and self.__stamps[ start % depth ] < limit:
+                number = numbers[ start % depth ]
+                if number == number:
+                    expired_sum += number
+                    expired_count += 1
+                start += 1
+            self.__expired = ( window_start, limit, start, expired_sum, expired_count )
+            total -= expired_sum
+            count -= expired_count
+        if count == 0:
+            return dict( count = 0, min = None, max = None, mean = None )
+        minimum = next( seq for seq in self.__min if seq >= start )
+        maximum = next( seq for seq in self.__max if seq >= start )
+        return dict( count = count,
+                     min = numbers[ minimum % depth ],
+                     max = numbers[ maximum % depth ],
+                     mean = total / count )
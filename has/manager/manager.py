@@ -10,11 +10,15 @@ Manager class implementation
 from has.utils.event import Watcher
 from has.utils.notification import Notification
 from has.manager.hc2.hc2driver import HC2Driver
+from has.manager.value import ValueID
 
 import logging
 import time
+from collections import deque
 from configparser import ConfigParser
-from threading import Lock
+from queue import Queue
+from threading import Lock, RLock, Thread, Timer
+from time import monotonic
 
 
 #logging.basicConfig(format='%(asctime)s %(levelname)s:\t%(message)s', filename='manager.log', filemode='w', level=logging.DEBUG)
@@ -23,30 +27,368 @@ from threading import Lock
 logger = logging.getLogger('manager')
 
 
+"""
+Driver configuration options converted to bool
+"""
+driver_bool_options = ( 'remote', 'columnar' )
+
+"""
+Value attributes returned by Manager.get_values and Manager.snapshot.
+Each getter is called with the node and value objects while nodes are locked.
+"""
+value_field_getters = dict( value = lambda node, value: value.get(),
+                            typed_value = lambda node, value: value.get_typed(),
+                            value_as_string = lambda node, value: value.get_as_string(),
+                            units = lambda node, value: value.units,
+                            value_type = lambda node, value: value.value_type,
+                            label = lambda node, value: value.label,
+                            read_only = lambda node, value: value.is_read_only,
+                            last_changed = lambda node, value: value.last_changed.strftime("%Y-%m-%d %H:%M:%S"),
+                            last_changed_epoch = lambda node, value: value.last_changed_epoch,
+                            node_name = lambda node, value: node.name,
+                            stale = lambda node, value: node.stale,
+                            node_type = lambda node, value: node.node_type,
+                            location_name = lambda node, value: node.location_name )
+default_value_fields = ( 'value', 'units', 'last_changed', 'node_name' )
+
+
 def singleton(cls):
     return cls()
 
+
+class BatchWatcher(Watcher):
+    """
+    Watcher receiving the lists of notifications instead of the single notification
+    """
+    def __init__(self, callback, context, max_batch, max_delay):
+        """
+        Params:
+            callback    :    function called with (notifications, context)
+            context     :    context passed to the callback
+            max_batch   :    maximum number of notifications in the list
+            max_delay   :    maximum time in seconds the notification waits for the batch to fill up
+                             0 - batch delivered at the end of each driver tick
+        """
+        Watcher.__init__(self, callback, context)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []
+        self.oldest = None
+        self.timer = None
+        self.lock = Lock()
+    
+    def add(self, notification):
+        """
+        Collect the notification. Returns the full batch or None
+        """
+        with self.lock:
+            if not self.pending:
+                self.oldest = monotonic()
+            self.pending.append( notification )
+            if len( self.pending ) >= self.max_batch:
+                return self.__take()
+        return None
+    
+    def take(self, force=False):
+        """
+        Returns the collected notifications if the batch is due (or forced) and the number
+        of seconds to wait for the rest of the batch (None if nothing pending)
+        """
+        with self.lock:
+            if not self.pending:
+                return None, None
+            delay = self.oldest + self.max_delay - monotonic()
+            if force or delay <= 0:
+                return self.__take(), None
+            return None, delay
+    
+    def __take(self):
+        batch = self.pending
+        self.pending = []
+        self.oldest = None
+        return batch
+
+
+class WatcherFilter(object):
+    """
+    Notification filter of the watcher. None matches any value.
+    """
+    def __init__(self, types=None, network_id=None, node_id=None, value_id=None, value_type=None):
+        """
+        Params:
+            types       :    Notification type or the collection of types
+            network_id  :    network id
+            node_id     :    node id (network_id should be provided too)
+            value_id    :    ValueID object
+            value_type  :    value type i.e. 'valueSensor'
+        """
+        if types is not None and not isinstance( types, ( list, tuple, set, frozenset ) ):
+            types = ( types, )
+        self.types = frozenset( types ) if types is not None else None
+        self.network_id = str( network_id ) if network_id is not None else None
+        self.node_id = str( node_id ) if node_id is not None else None
+        self.value_id = value_id
+        self.value_type = str( value_type ) if value_type is not None else None
+        
+    def match(self, notification):
+        if self.types is not None and notification.type not in self.types:
+            return False
+        if self.network_id is not None and notification.network_id != self.network_id:
+            return False
+        if self.node_id is not None and notification.node_id != self.node_id:
+            return False
+        value_id = notification.value_id
+        if self.value_id is not None and value_id != self.value_id:
+            return False
+        if self.value_type is not None and ( value_id is None or value_id.value_type != self.value_type ):
+            return False
+        return True
+
+
+class WatcherIndex(object):
+    """
+    Immutable dispatch index of the watchers.
+    Every watcher is indexed by the most selective field of its filter, so the lookup
+    returns only the watchers which may be interested in the notification.
+    """
+    def __init__(self, watchers):
+        self.watchers = tuple( watchers )
+        self.batch_watchers = tuple( w for w in self.watchers if isinstance( w, BatchWatcher ) )
+        self.__by_value_id = {}
+        self.__by_node = {}
+        self.__by_network = {}
+        self.__by_value_type = {}
+        self.__by_type = {}
+        self.__any = []
+        
+        for seq, watcher in enumerate( self.watchers ):
+            f = watcher.filter
+            entry = ( seq, watcher )
+            if f is None:
+                self.__any.append( entry )
+            elif f.value_id is not None:
+                self.__by_value_id.setdefault( f.value_id, [] ).append( entry )
+            elif f.node_id is not None:
+                self.__by_node.setdefault( ( f.network_id, f.node_id ), [] ).append( entry )
+            elif f.network_id is not None:
+                self.__by_network.setdefault( f.network_id, [] ).append( entry )
+            elif f.value_type is not None:
+                self.__by_value_type.setdefault( f.value_type, [] ).append( entry )
+            elif f.types is not None:
+                for notification_type in set( f.types ):
+                    self.__by_type.setdefault( notification_type, [] ).append( entry )
+            else:
+                self.__any.append( entry )
+    
+    def lookup(self, notification):
+        """
+        Returns the list of watchers matching the notification in the registration order
+        """
+        candidates = []
+        value_id = notification.value_id
+        if value_id is not None:
+            candidates.extend( self.__by_value_id.get( value_id, () ) )
+            candidates.extend( self.__by_value_type.get( value_id.value_type, () ) )
+        if self.__by_node:
+            candidates.extend( self.__by_node.get( ( notification.network_id, notification.node_id ), () ) )
+            if notification.network_id is not None:   # same key otherwise
+                candidates.extend( self.__by_node.get( ( None, notification.node_id ), () ) )
+        candidates.extend( self.__by_network.get( notification.network_id, () ) )
+        candidates.extend( self.__by_type.get( notification.type, () ) )
+        
+        if candidates:
+            candidates.extend( self.__any )
+            candidates.sort( key = lambda entry: entry[0] )
+        else:
+            candidates = self.__any
+        
+        return [ watcher for seq, watcher in candidates 
+                    if watcher.filter is None or watcher.filter.match( notification ) ]
+
+
+class WatcherQueue(object):
+    """
+    Bounded queue of the notifications waiting for delivery to the single watcher
+    """
+    def __init__(self, watcher, size):
+        self.watcher = watcher
+        self.size = size
+        self.items = deque()
+        self.lock = Lock()
+        self.scheduled = False   # queue is handled by (or waiting for) the worker
+        self.delivered = 0
+        self.dropped = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+
+class NotificationDispatcher(object):
+    """
+    Delivers the notifications to the watchers from the pool of worker threads.
+    Each watcher has its own bounded queue served by at most one worker at a time,
+    so the notifications are delivered to the watcher in order and the slow watcher
+    does not delay the others nor the driver thread.
+    On stop the notifications left in the queues are delivered from the stopping thread,
+    dispatch returns False once the dispatcher is stopped.
+    """
+    max_burst = 32  # notifications delivered to the watcher before the worker moves on
+    
+    def __init__(self, workers=2, queue_size=1000):
+        """
+        Params:
+            workers     :    number of worker threads
+            queue_size  :    maximum number of notifications waiting per watcher.
+                             The oldest notification is dropped when exceeded.
+        """
+        self.queue_size = queue_size
+        self.__queues = {}
+        self.__lock = Lock()        # queues, stopping and stopped
+        self.__stopping = False     # workers are stopping, queued items are delivered by stop
+        self.__stopped = False
+        self.__ready = Queue()
+        self.__threads = []
+        for i in range( workers ):
+            thread = Thread( target=self.__worker, name="Dispatcher-{0}".format( i ) )
+            thread.daemon = True
+            thread.start()
+            self.__threads.append( thread )
+    
+    def register(self, watcher):
+        with self.__lock:
+            self.__queues[id(watcher)] = WatcherQueue( watcher, self.queue_size )
+    
+    def unregister(self, watcher):
+        with self.__lock:
+            self.__queues.pop( id(watcher), None )
+    
+    def dispatch(self, watcher, notification):
+        """
+        Queue the notification for the watcher.
+        Returns False if the dispatcher is stopped, the caller delivers the notification itself.
+        """
+        with self.__lock:
+            if self.__stopped:
+                return False
+            queue = self.__queues.get( id(watcher) )
+            if queue is None:
+                return True
+            with queue.lock:
+                if len( queue.items ) >= queue.size:
+                    queue.items.popleft()
+                    queue.dropped += 1
+                queue.items.append( ( monotonic(), notification ) )
+                if queue.scheduled or self.__stopping:
+                    return True
+                queue.scheduled = True
+        self.__ready.put( queue )
+        return True
+    
+    def stop(self):
+        """
+        Stop the workers and deliver the notifications left in the queues from the calling thread
+        """
+        with self.__lock:
+            self.__stopping = True
+        for thread in self.__threads:
+            self.__ready.put( None )
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        
+        while True:   # notifications dispatched meanwhile are queued and delivered here in order
+            with self.__lock:
+                pending = [ queue for queue in self.__queues.values() if queue.items ]
+                if not pending:
+                    self.__stopped = True
+                    break
+            for queue in pending:
+                while self.__deliver( queue ):
+                    pass
+    
+    def stats(self):
+        """
+        Returns the list of dictionaries with per watcher delivery statistics
+        """
+        result = []
+        for queue in list( self.__queues.values() ):
+            result.append( dict( callback = queue.watcher.callback,
+                                 context = queue.watcher.context,
+                                 pending = len( queue.items ),
+                                 delivered = queue.delivered,
+                                 dropped = queue.dropped,
+                                 lag = queue.lag,
+                                 max_lag = queue.max_lag ) )
+        return result
+    
+    def __worker(self):
+        while True:
+            queue = self.__ready.get()
+            if queue is None:
+                break
+            if self.__deliver( queue ):
+                self.__ready.put( queue )   # more pending - let other watchers go first
+    
+    def __deliver(self, queue):
+        """
+        Deliver up to max_burst notifications. Returns True if more are pending
+        """
+        watcher = queue.watcher
+        for i in range( self.max_burst ):
+            with queue.lock:
+                if not queue.items:
+                    queue.scheduled = False
+                    return False
+                queued, notification = queue.items.popleft()
+            
+            lag = monotonic() - queued
+            queue.lag = lag
+            if lag > queue.max_lag:
+                queue.max_lag = lag
+            try:
+                watcher.callback( notification, watcher.context )
+            except Exception as e:
+                logger.error("NotificationDispatcher: watcher {0} exception: {1}".format( watcher.callback, e ) )
+            queue.delivered += 1
+        return True
+
 @singleton    
 class Manager(object):
     """Manager object to run the entire application"""
+    
+    """
+    Per item results of set_values
+    """
+    SetResult_Sent, \
+    SetResult_Failed, \
+    SetResult_NotFound, \
+    SetResult_ReadOnly, \
+    SetResult_NotSupported = range(5)
+    
     def __init__( self ):
-        self.pending_drivers = []
-        self.ready_drivers = []
-        self.watchers = []
-        self.notification_lock = Lock()
+        self.pending_drivers = {}   # network_id -> driver
+        self.ready_drivers = {}     # network_id -> driver
+        self.watcher_index = WatcherIndex( () )   # copy-on-write: replaced, never modified
+        self.notification_lock = Lock()   # watchers list
+        self.delivery_lock = RLock()      # watcher callbacks called without dispatcher, one at a time
+        self.dispatcher = None
         
     def read_config(self, filename='manager.ini'):
         config = ConfigParser()
         config.read(filename)
         print(config.sections())
         
-        
+        if config.has_section('manager'):
+            workers = config['manager'].getint('dispatcher_workers', 0)
+            if workers > 0:
+                self.start_dispatcher( workers, config['manager'].getint('dispatcher_queue_size', 1000) )
         
         for section in config.sections():
             if section.startswith('driver'):
                 driver_cls = section.split('.')[1]
                 params = config._sections[section]
-                params['remote'] = config[section].getboolean('remote')
+                for option in driver_bool_options:
+                    if option in params:
+                        params[option] = config[section].getboolean(option)
                 driver = None
                 try:
                     driver = eval("{0}(**params)".format(driver_cls))
@@ -60,20 +402,15 @@ class Manager(object):
             
     def close(self):
         self.remove_driver()
+        self.stop_dispatcher()
     
     def add_driver(self, new_driver):
         new_network_id = new_driver.get_network()
-        for driver in self.pending_drivers:
-            if driver.get_network() == new_network_id:
-                logger.error( "Cannot add driver for %s - driver already exists" % new_network_id )
-                return False
-                
-        for driver in self.ready_drivers:
-            if driver.get_network() == new_network_id:
-                logger.error( "Cannot add driver for %s - driver already exists" % new_network_id )
-                return False
+        if new_network_id in self.pending_drivers or new_network_id in self.ready_drivers:
+            logger.error( "Cannot add driver for %s - driver already exists" % new_network_id )
+            return False
                 
-        self.pending_drivers.append(new_driver)
+        self.pending_drivers[new_network_id] = new_driver
         new_driver.set_manager(self)
         new_driver.start()
         return True
@@ -83,71 +420,192 @@ class Manager(object):
         print("Remove all: %s" % remove_all)
         
         logger.debug( "Manager.remove_driver: %s" % network_id )
-        for driver in self.pending_drivers[:]:
-            if (driver.get_network() == network_id) or remove_all:
-                self.pending_drivers.remove(driver)
-                driver.stop()
-                logger.info( "Driver %s - removed" % driver.get_network() )
-                
-        
-        for driver in self.ready_drivers[:]:
-            if (driver.get_network() == network_id) or remove_all:
-                self.ready_drivers.remove(driver)
-                driver.stop()
-                logger.info( "Driver %s - removed" % driver.get_network() )
+        for drivers in ( self.pending_drivers, self.ready_drivers ):
+            network_ids = list( drivers ) if remove_all else [ network_id ]
+            for driver_network_id in network_ids:
+                driver = drivers.pop( driver_network_id, None )
+                if driver is not None:
+                    driver.stop()
+                    logger.info( "Driver %s - removed" % driver_network_id )
                     
     def get_driver(self, network_id):
-        for driver in self.ready_drivers:
-            if driver.get_network() == network_id:
-                return driver
-        return None    
+        """
+        Returns the ready driver or the pending driver serving the state loaded from the cache
+        """
+        driver = self.ready_drivers.get( network_id )
+        if driver is None:
+            driver = self.pending_drivers.get( network_id )
+            if driver is not None and not driver.cache_loaded:
+                driver = None
+        return driver
     
     
     def set_driver_ready(self, driver, success):
-        found = False
-        for driver_obj in self.pending_drivers:
-            if driver_obj.get_network() == driver.get_network():
-                print('found: %s' % driver)
-                self.pending_drivers.remove(driver)
-                found = True
-                break
+        found = self.pending_drivers.pop( driver.get_network(), None ) is not None
         if found:
+            print('found: %s' % driver)
             if success:
                 logger.info( "Driver for %s is now ready" % driver.get_network() )
-                notification = Notification( Notification.Type_DriverReady )
-                self.ready_drivers.append( driver )
+                notification = Notification( Notification.Type_DriverReady, driver.get_network() )
+                self.ready_drivers[driver.get_network()] = driver
             else:
-                notification = Notification( Notification.Type_DriverFailed )
+                notification = Notification( Notification.Type_DriverFailed, driver.get_network() )
                 driver.stop()
             
-            
-            notification.network = driver.get_network()
             driver.queue_notification( notification ) 
     
     
-    def add_watcher(self, callback, context):
+    def start_dispatcher(self, workers=2, queue_size=1000):
+        """
+        Deliver the notifications from the pool of worker threads instead of the driver thread.
+        
+        Params:
+            workers     :    number of worker threads
+            queue_size  :    maximum number of notifications waiting per watcher
+        """
+        with self.notification_lock:
+            if self.dispatcher is not None:
+                return False
+            dispatcher = NotificationDispatcher( workers, queue_size )
+            for watcher in self.watcher_index.watchers:
+                dispatcher.register( watcher )
+            self.dispatcher = dispatcher
+        return True
+    
+    def stop_dispatcher(self):
+        with self.notification_lock:
+            dispatcher = self.dispatcher
+            self.dispatcher = None
+        if dispatcher is not None:
+            dispatcher.stop()
+    
+    def get_watcher_lag(self):
+        """
+        Returns the list of per watcher dictionaries with the delivery statistics:
+        callback, context, pending, delivered, dropped, lag, max_lag (seconds)
+        Empty list if dispatcher is not running.
+        """
+        dispatcher = self.dispatcher
+        if dispatcher is None:
+            return []
+        return dispatcher.stats()
+    
+    def add_watcher(self, callback, context, types=None, network_id=None, node_id=None, value_id=None, value_type=None):
+        """
+        Add the watcher called with (notification, context) for each notification
+        matching the filter. Filter parameters set to None match any value.
+        
+        Params:
+            types       :    Notification type or the collection of types
+            network_id  :    network id
+            node_id     :    node id
+            value_id    :    ValueID object
+            value_type  :    value type i.e. 'valueSensor'
+        """
         watcher = Watcher( callback, context )
+        return self.__add_watcher( watcher, types, network_id, node_id, value_id, value_type )
+    
+    def add_batch_watcher(self, callback, context, max_batch=100, max_delay=0, 
+                          types=None, network_id=None, node_id=None, value_id=None, value_type=None):
+        """
+        Add the watcher receiving the lists of notifications.
+        Notifications are collected and delivered at the end of the driver tick,
+        when max_batch notifications are collected or max_delay seconds passed.
+        
+        Params:
+            callback    :    function called with (notifications, context) where notifications is a list
+            context     :    context passed to the callback
+            max_batch   :    maximum number of notifications in the list
+            max_delay   :    maximum time in seconds the notification waits for the batch to fill up
+            
+            Filter parameters as in add_watcher
+        """
+        watcher = BatchWatcher( callback, context, max_batch, max_delay )
+        return self.__add_watcher( watcher, types, network_id, node_id, value_id, value_type )
+    
+    def __add_watcher(self, watcher, types, network_id, node_id, value_id, value_type):
+        if ( types, network_id, node_id, value_id, value_type ) == ( None, ) * 5:
+            watcher.filter = None
+        else:
+            watcher.filter = WatcherFilter( types, network_id, node_id, value_id, value_type )
+        
         with self.notification_lock:
-            for w in self.watchers[:]:
+            for w in self.watcher_index.watchers:
                 if w == watcher: # Watcher already exists
-                    self.notification_lock.release()
                     return False
-            self.watchers.append( watcher )
+            if self.dispatcher is not None:
+                self.dispatcher.register( watcher )
+            self.watcher_index = WatcherIndex( self.watcher_index.watchers + ( watcher, ) )
         return True
         
     def remove_watcher(self, callback, context):
         watcher = Watcher( callback, context )
+        removed = None
+        batch = None
         with self.notification_lock:
-            for w in self.watchers[:]:
+            for w in self.watcher_index.watchers:
                 if w == watcher:
-                    self.watchers.remove( watcher )
-                    return True
-        return False    
+                    self.watcher_index = WatcherIndex( x for x in self.watcher_index.watchers if x is not w )
+                    if self.dispatcher is not None:
+                        self.dispatcher.unregister( w )
+                    if isinstance( w, BatchWatcher ):
+                        batch, delay = w.take( force=True )
+                    removed = w
+                    break
+        if removed is None:
+            return False
+        if batch:   # outside the watchers lock, so the callback can add or remove watchers
+            with self.delivery_lock:
+                removed.callback( batch, removed.context )
+        return True
         
     def notify_watchers(self, notification):
-        with self.notification_lock:
-            for watcher in self.watchers:
-                watcher.callback( notification, watcher.context)
+        """
+        Called from driver thread. The watchers lock is not taken, so the watcher callback can add or remove watchers.
+        Without the dispatcher the callbacks are called under delivery_lock, so a callback
+        is never called from two driver threads at once.
+        Only the watchers with matching filter are called.
+        """
+        for watcher in self.watcher_index.lookup( notification ):
+            if isinstance( watcher, BatchWatcher ):
+                batch = watcher.add( notification )
+                if batch is not None:
+                    self.__deliver( watcher, batch )
+            else:
+                self.__deliver( watcher, notification )
+    
+    def flush_watchers(self, driver=None):
+        """
+        Deliver the notifications collected by the batch watchers.
+        Called by the driver at the end of the tick. When a batch is not due yet the timer
+        is started which requests the flush from the driver thread (see Driver.request_flush),
+        so the batches are never delivered concurrently with the driver thread deliveries.
+        
+        Params:
+            driver  :    driver calling the flush
+        """
+        for watcher in self.watcher_index.batch_watchers:
+            batch, delay = watcher.take()
+            if batch is not None:
+                self.__deliver( watcher, batch )
+            elif delay is not None and driver is not None:
+                with watcher.lock:
+                    if watcher.timer is None:
+                        watcher.timer = Timer( delay, self.__flush_timer, ( watcher, driver ) )
+                        watcher.timer.daemon = True
+                        watcher.timer.start()
+    
+    def __flush_timer(self, watcher, driver):
+        with watcher.lock:
+            watcher.timer = None
+        driver.request_flush()
+    
+    def __deliver(self, watcher, notification):
+        dispatcher = self.dispatcher
+        if dispatcher is not None and dispatcher.dispatch( watcher, notification ):
+            return
+        with self.delivery_lock:
+            watcher.callback( notification, watcher.context )
 
 #-------------------- nodes
     
@@ -197,79 +655,335 @@ class Manager(object):
             res = driver.is_node_battery_operated( node_id )
         return res
         
+    def is_node_stale(self, network_id, node_id):
+        """
+        Returns True if the node state comes from the state cache and was not refreshed yet
+        """
+        res = False
+        driver = self.get_driver( network_id )
+        if driver:
+            node = driver.get_node_shared( node_id )
+            if node:
+                res = node.stale
+                driver.release_nodes_shared()
+        return res
+    
+    def get_lock_stats(self, network_id):
+        """
+        Returns the dictionary with the node lock wait and hold time statistics of the driver
+        (see RWLock.get_stats) or None if driver does not exist
+        """
+        driver = self.get_driver( network_id )
+        if driver:
+            return driver.node_lock.get_stats()
+        return None
+    
+    def get_bootstrap_times(self, network_id):
+        """
+        Returns the dictionary with the seconds from the initial data request
+        to the handled response per request or None if driver does not exist
+        """
+        driver = self.get_driver( network_id )
+        if driver:
+            return dict( driver.bootstrap_times )
+        return None
+        
 #---------------------- values
+# value_id parameter can be either ValueID object or its integer handle
+
+    def get_value_handle(self, value_id):
+        """
+        Returns the integer handle of the ValueID which can be used instead of ValueID
+        """
+        return value_id.handle
+    
 
     def get_value(self, value_id):
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
         v = None
         driver = self.get_driver( value_id.network_id )
-        driver.lock_nodes()
+        driver.lock_nodes_shared()
         value_obj = driver.get_value( value_id )
         if value_obj is not None:
             v = value_obj.get()
-        driver.release_nodes()
+        driver.release_nodes_shared()
         return v
         
     def get_value_as_string(self, value_id):
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
         v = None
         driver = self.get_driver( value_id.network_id )
-        driver.lock_nodes()
+        driver.lock_nodes_shared()
         value_obj = driver.get_value( value_id )
         if value_obj is not None:
             v = value_obj.get_as_string()
-        driver.release_nodes()
+        driver.release_nodes_shared()
         return v
     
     def set_value(self, value_id, value):
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return
         try:
             driver = self.get_driver( value_id.network_id)
-            driver.lock_nodes()
+            driver.lock_nodes_shared()
             value_obj = driver.get_value( value_id )
             if value_obj is not None:
                 v = value_obj.set( value )
-            driver.release_nodes()
+            driver.release_nodes_shared()
         
         except Exception as e:
             print(e)
         return
     
+    def set_values(self, values):
+        """
+        Set many values at once. All the items are validated first (value exists and is not read only)
+        then the commands of the valid items are sent concurrently over the controller connections.
+        Blocks until the commands are sent. Returns the list of (value_id, result) tuples
+        in the input order, where result is one of the Manager.SetResult_* constants.
+        
+        Params:
+            values  :    iterable of (value_id, value) tuples; value_id can be ValueID or integer handle
+        """
+        results = []
+        by_driver = {}
+        for value_id, value in values:
+            index = len( results )
+            results.append( [ value_id, Manager.SetResult_NotFound ] )
+            value_id = ValueID.resolve( value_id )
+            if value_id is None:
+                continue
+            results[index][0] = value_id
+            
+            driver = self.get_driver( value_id.network_id )
+            if driver is None:
+                continue
+            driver.lock_nodes_shared()
+            try:
+                node = driver.get_node_unsafe( value_id.node_id )
+                value_obj = node.get_value( value_id ) if node is not None else None
+                if value_obj is None:
+                    continue
+                if value_obj.is_read_only:
+                    results[index][1] = Manager.SetResult_ReadOnly
+                    continue
+                command = node.get_set_command( value_id, value )
+            finally:
+                driver.release_nodes_shared()
+            
+            if command is None:
+                results[index][1] = Manager.SetResult_NotSupported
+                continue
+            by_driver.setdefault( driver, [] ).append( ( index, command ) )
+        
+        for driver, commands in by_driver.items():
+            sent = driver.send_msgs( [ command for index, command in commands ] )
+            for ( index, command ), ok in zip( commands, sent ):
+                results[index][1] = Manager.SetResult_Sent if ok else Manager.SetResult_Failed
+        
+        return [ tuple( result ) for result in results ]
+    
     def get_value_id(self, value_id):
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
         unique_value_id = None
         driver = self.get_driver( value_id.network_id )
-        driver.lock_nodes()
+        driver.lock_nodes_shared()
         value = driver.get_value( value_id )
         if value is not None:
             unique_value_id = value.value_id
-        driver.release_nodes()
+        driver.release_nodes_shared()
         
         return unique_value_id
     
     
     def get_value_type(self, value_id):
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
         value_type = None
         driver = self.get_driver( value_id.network_id )
-        driver.lock_nodes()
+        driver.lock_nodes_shared()
         value = driver.get_value( value_id )
         if value is not None:
             value_type = value.value_type
-        driver.release_nodes()
+        driver.release_nodes_shared()
         return value_type
         
     def get_value_last_changed(self, value_id):
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
         value_last_changed = None
         driver = self.get_driver( value_id.network_id )
-        driver.lock_nodes()
+        driver.lock_nodes_shared()
         value = driver.get_value( value_id )
         if value is not None:
             value_last_changed = value.last_changed.strftime("%Y-%m-%d %H:%M:%S")
-        driver.release_nodes()
+        driver.release_nodes_shared()
         return value_last_changed
     
+    def get_values(self, value_ids, fields=default_value_fields):
+        """
+        Returns the dictionary of {value_id: {field: value}} with the requested attributes
+        of all the values. Values of each network are read under single driver lock so the
+        result is consistent. Values which do not exist are mapped to None.
+        
+        Params:
+            value_ids   :    iterable of ValueID objects or integer handles
+            fields      :    tuple of attribute names (see value_field_getters)
+        """
+        getters = self.__field_getters( fields )
+        by_network = {}
+        result = {}
+        for value_id in value_ids:
+            resolved = ValueID.resolve( value_id )
+            if resolved is None:
+                result[value_id] = None
+                continue
+            by_network.setdefault( resolved.network_id, [] ).append( resolved )
+        
+        for network_id, network_value_ids in by_network.items():
+            driver = self.get_driver( network_id )
+            if driver is None:
+                result.update( dict.fromkeys( network_value_ids ) )
+                continue
+            driver.lock_nodes_shared()
+            try:
+                for value_id in network_value_ids:
+                    node = driver.get_node_unsafe( value_id.node_id )
+                    value = node.get_value( value_id ) if node is not None else None
+                    if value is None:
+                        result[value_id] = None
+                    else:
+                        result[value_id] = { field: getter( node, value ) for field, getter in getters }
+            finally:
+                driver.release_nodes_shared()
+        return result
+    
+    def snapshot(self, network_id, fields=default_value_fields):
+        """
+        Returns the dictionary of {value_id: {field: value}} with the requested attributes
+        of all the values of the network taken under single driver lock
+        or None if the driver does not exist.
+        
+        Params:
+            network_id  :    network id
+            fields      :    tuple of attribute names (see value_field_getters)
+        """
+        getters = self.__field_getters( fields )
+        driver = self.get_driver( network_id )
+        if driver is None:
+            return None
+        
+        result = {}
+        driver.lock_nodes_shared()
+        try:
+            for node in driver.nodes.values():
+                for value in node.values():
+                    result[value.value_id] = { field: getter( node, value ) for field, getter in getters }
+        finally:
+            driver.release_nodes_shared()
+        return result
+    
+    def __field_getters(self, fields):
+        try:
+            return [ ( field, value_field_getters[field] ) for field in fields ]
+        except KeyError as e:
+            raise ValueError( "Manager: Unknown value field {0}".format( e ) )
+    
+    def get_value_history(self, value_id, since=0):
+        """
+        Returns the list of (epoch, number) tuples of the value changes not older than since
+        (number is NaN if the value is not a number) or None if the value has no history.
+        
+        Params:
+            value_id    :    ValueID object or integer handle
+            since       :    epoch timestamp
+        """
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
+        history = None
+        driver = self.get_driver( value_id.network_id )
+        if driver is None:
+            return None
+        driver.lock_nodes_shared()
+        value = driver.get_value( value_id )
+        if value is not None and value.history is not None:
+            history = value.history.since( since )
+        driver.release_nodes_shared()
+        return history
+    
+    def get_value_window_stats(self, value_id):
+        """
+        Returns the dictionary with count, min, max and mean of the value over the history window
+        (history_window setting) ending now or None if the value has no history.
+        """
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
+        stats = None
+        driver = self.get_driver( value_id.network_id )
+        if driver is None:
+            return None
+        driver.lock_nodes_shared()
+        value = driver.get_value( value_id )
+        if value is not None and value.history is not None:
+            stats = value.history.window_stats( monotonic() )
+        driver.release_nodes_shared()
+        return stats
+
+    def get_value_log(self, value_ids, start, end=None):
+        """
+        Returns the list of (ValueID, epoch, value) tuples of the numeric value changes
+        in the time range read from the drivers change logs (changelog_dir setting), oldest first per network.
+
+        Params:
+            value_ids   :    list of ValueID objects or integer handles
+            start       :    epoch timestamp, inclusive
+            end         :    epoch timestamp, inclusive (no limit if None)
+        """
+        networks = {}
+        for value_id in value_ids:
+            value_id = ValueID.resolve( value_id )
+            if value_id is not None:
+                networks.setdefault( value_id.network_id, [] ).append( value_id )
+
+        result = []
+        for network_id, ids in networks.items():
+            driver = self.get_driver( network_id )
+            if driver is None or driver.changelog is None:
+                continue
+            result.extend( driver.changelog.scan( start, end, ids ) )
+        return result
+
+    def snapshot_arrays(self, network_id):
+        """
+        Returns the dictionary of NumPy arrays (handle, value, timestamp, units) with all the values
+        of the network or None if the driver does not keep the values in the columnar store.
+        Requires numpy.
+        """
+        driver = self.get_driver( network_id )
+        if driver is None or driver.value_store is None:
+            return None
+        return driver.value_store.snapshot()
+    
     def get_value_units(self, value_id):
+        value_id = ValueID.resolve( value_id )
+        if value_id is None:
+            return None
         units = None
         driver = self.get_driver( value_id.network_id)
-        driver.lock_nodes()
+        driver.lock_nodes_shared()
         value = driver.get_value( value_id )
         if value is not None:
             units = value.units
-        driver.release_nodes()
+        driver.release_nodes_shared()
         return units
@@ -6,6 +6,7 @@ Generic Z-Wave Node class implementation
 
 """
 import logging
+import weakref
 
 from has.manager.value import Value, ValueID
 from has.utils.notification import Notification
@@ -20,7 +21,12 @@ class Node(object):
     QueryStage_Complete, \
     QueryStage_None = range(4)
     
-    def __init__(self, network_id, node_id):
+    """
+    Maximum number of the node info queries sent before the node is given up
+    """
+    max_query_retries = 3
+    
+    def __init__(self, network_id, node_id, driver=None):
         self._network_id = network_id
         self._node_id = node_id
         self._query_pending = False
@@ -28,20 +34,21 @@ class Node(object):
         self._node_info_received = False
         self._values_info_received = False
         self.__query_stage = Node.QueryStage_None
+        self.stale = False   # True if loaded from the state cache and not yet refreshed
         
         """
         Private attributes
         """
-        self.__values = []
+        self.__values = {}   # value_type -> Value
+        self.__driver = weakref.ref( driver ) if driver is not None else None
         self.__query_retries = 0
         self.__add_QSC = False
 
         
     @property    
     def driver(self):
-        from has.manager.manager import Manager
-        driver = Manager.get_driver( self._network_id )
-        return driver
+        """ Driver owning the node (weak reference) """
+        return self.__driver() if self.__driver is not None else None
         
     @property
     def name(self):
@@ -123,8 +130,21 @@ class Node(object):
         raise NotImplemented
         return None
     
+    def query_failed(self):
+        """
+        Called by the driver when the node info query expired in the message queue or was rejected.
+        The query is sent again, up to max_query_retries times.
+        """
+        if self.__query_stage != Node.QueryStage_NodeInfo or self._node_info_received:
+            return
+        logger.info("Node {0}: Node info query failed".format( self._node_id ) )
+        self._query_pending = False
+        self.advance_queries()
+    
     def advance_queries(self):
         self.add_QSC = False
+        if self.query_stage != Node.QueryStage_Complete:
+            self.driver.pending_nodes.add( self._node_id )
         logger.debug("Node {0}: queryPending={1} queryStage={2}".format(self._node_id, self._query_pending, self.query_stage ) )
         while not self._query_pending:
             
@@ -138,10 +158,16 @@ class Node(object):
             elif self.query_stage == Node.QueryStage_NodeInfo:
                 logger.debug("Node {0}: Query Stage NodeInfo".format(self._node_id) )
                 if not self._node_info_received:
+                    if self.__query_retries >= Node.max_query_retries:
+                        logger.error("Node {0}: Node info not received after {1} queries".format( self._node_id, self.__query_retries ) )
+                        self.__query_stage = Node.QueryStage_Complete   # do not hold the other nodes
+                        continue
+                    self.__query_retries += 1
+                    self._query_pending = True
+                    # advanced when the response arrives or by query_failed
                     self.query_node_info()
                     #logger.info("advance_queries: Node: {0} Query command sent %s".format(self._node_id))
-                    self._query_pending = True
-                    self.add_QSC = True
+                    return
                 else:
                     #logger.debug("advance_queries: Node: {0} Move to stage NodeValues".format(self._node_id))
                     self.__query_stage = Node.QueryStage_NodeValues
@@ -149,9 +175,12 @@ class Node(object):
 
             
             elif self.query_stage == Node.QueryStage_NodeValues:
-                assert self._node_info_received == True, "Advanced to query node values but not info not received"
                 logger.debug("Node {0}: Query Stage NodeValues".format(self._node_id) )
-                if not self._values_info_received:
+                if not self._node_info_received:
+                    # node info query dropped from the message queue (expired) - query again
+                    logger.debug("Node {0}: Node info not received. Back to stage NodeInfo".format(self._node_id) )
+                    self.__query_stage = Node.QueryStage_NodeInfo
+                elif not self._values_info_received:
                     logger.debug("advance_queries: Node: {0} Update values info command send".format(self._node_id) )
                     self.update_values_info()
                     self._query_pending = True
@@ -164,11 +193,9 @@ class Node(object):
                                 
             elif self.query_stage == Node.QueryStage_Complete:
                 logger.info("Node {0}: All Queries Complete".format(self._node_id) )
-                notification = Notification( Notification.Type_NodeQueriesComplete )
-                notification.node_id = self._node_id
-                notification.network_id = self._network_id
+                notification = Notification( Notification.Type_NodeQueriesComplete, self._network_id, self._node_id, self.node_type )
                 self.driver.queue_notification( notification )
-                self.driver.check_completed_node_queries()
+                self.driver.check_completed_node_queries( self._node_id )
                 return
 
     
@@ -178,41 +205,108 @@ class Node(object):
             return
 
     def update_node_info(self, node_info):
+        """
+        Update the node info. Changes are detected per attribute (nested dictionaries per key):
+            - changed values are refreshed (ValueChanged notification for each changed value)
+            - other changed attributes are reported with the single NodeChanged notification
+            - if value types appeared or disappeared values are rebuilt in the NodeValues query stage
+        """
         logger.debug("Node:update_node_info: Node {0}:".format( self._node_id ) )
         assert node_info is not None, "Update node info with 'None' value"
         changes = set()
         if self._node_info is not None:
-            set_current, set_past = set(node_info.keys()), set(self._node_info.keys())
-            intersect = set_current.intersection(set_past)  
-            changes = set(o for o in intersect if self._node_info[o] != node_info[o])
+            changes = self.diff_node_info( self._node_info, node_info )
                     
         self._node_info = node_info
         self._node_info_received = True
         self._values_info_received = True  
+        self.stale = False
         
         if changes:
-            notification = Notification( Notification.Type_NodeChanged )
-            notification.node_id = self._node_id
-            notification.network_id = self._network_id
-            self.driver.queue_notification( notification ) 
-            self.set_query_stage( Node.QueryStage_NodeInfo )
+            logger.debug("Node {0}: Node info changes: {1}".format( self._node_id, changes ) )
+            node_changes = changes.difference( self.__values )
+            if self.value_types_changed():
+                notification = Notification( Notification.Type_NodeChanged, self._network_id, self._node_id, self.node_type )
+                self.driver.queue_notification( notification ) 
+                self.set_query_stage( Node.QueryStage_NodeValues )
+                return
+            
+            if len( node_changes ) < len( changes ):
+                self.update_values_info()
+            if node_changes:
+                notification = Notification( Notification.Type_NodeChanged, self._network_id, self._node_id, self.node_type )
+                self.driver.queue_notification( notification ) 
+    
+    @staticmethod
+    def diff_node_info(old, new):
+        """
+        Returns the set of attribute names added or changed in the new node info.
+        Attributes of the nested dictionaries are compared by their own names
+        and also reported when removed.
+        """
+        changes = set()
+        for name, attr in new.items():
+            if name not in old:
+                changes.add( name )
+                continue
+            old_attr = old[name]
+            if isinstance( attr, dict ) and isinstance( old_attr, dict ):
+                changes.update( key for key, item in attr.items() if key not in old_attr or old_attr[key] != item )
+                changes.update( key for key in old_attr if key not in attr )
+            elif old_attr != attr:
+                changes.add( name )
+        return changes
+    
+    def value_types_changed(self):
+        """
+        Returns True if the node info contains different set of value types than the node values
+        """
+        return False
     
     def create_value_id(self, value_type):
         return ValueID( self._network_id, self._node_id, value_type)
         
     def add_value(self, value_obj):
         logger.debug("Node:add_value: ValueID:%s" % value_obj.value_id)
-        self.__values.insert(0, value_obj)
-        notification = Notification( Notification.Type_ValueAdded )
-        notification.node_id = self._node_id
-        notification.network_id = self._network_id
-        notification.value_id = value_obj.value_id
+        driver = self.driver
+        value_obj.bind_driver( driver )
+        if driver.history_depth > 0:
+            value_obj.enable_history( driver.history_depth, driver.history_window )
+        store = driver.value_store
+        if store is not None:
+            value_obj = value_obj.bind_store( store )   # replaced with the ValueView
+        self.__values[value_obj.value_type] = value_obj
+        notification = Notification( Notification.Type_ValueAdded, self._network_id, self._node_id,
+                                     value_id = value_obj.value_id, new_value = value_obj.get() )
+        driver.queue_notification( notification )
+    
+    def remove_value(self, value_type):
+        """
+        Removes the Value instance from the node. Returns True if removed.
+        
+        Params:
+            value_type: value type string
+        """
+        value_obj = self.__values.pop( value_type, None )
+        if value_obj is None:
+            return False
+        value_obj.unbind_store()
+        logger.debug("Node:remove_value: ValueID:%s" % value_obj.value_id)
+        notification = Notification( Notification.Type_ValueRemoved, self._network_id, self._node_id,
+                                     value_id = value_obj.value_id, old_value = value_obj.get() )
         self.driver.queue_notification( notification )
+        return True
+    
+    def release_values(self):
+        """
+        Release the store rows of all the values. Called when the node is removed
+        """
+        for value_obj in self.__values.values():
+            value_obj.unbind_store()
     
     def update_value(self, value_type, value):
         logger.debug("Node:update_value: ValueType:%s" % value_type)
-        value_id = self.create_value_id( value_type )
-        value_obj = self.get_value( value_id )
+        value_obj = self.__values.get( value_type )
         if value_obj:
             value_obj.on_value_refresh( value ) 
         else:
@@ -228,13 +322,37 @@ class Node(object):
         Params:
             value_id:   ValueID object
         """
-            
-        for value_obj in self.__values:
-            if value_obj.value_id == value_id:
-                return value_obj
-        return None
+        return self.__values.get( value_id.value_type )
+    
+    def get_value_by_type(self, value_type):
+        """
+        Returns the Value instance of given type or None if not extis.
+        
+        Params:
+            value_type: value type string
+        """
+        return self.__values.get( value_type )
+    
+    def values(self):
+        """
+        Returns the list of Value instances belonging to the node
+        """
+        return list( self.__values.values() )
+    
+    def value_types(self):
+        """
+        Returns the list of value types of the node
+        """
+        return list( self.__values.keys() )
         
     def set_value(self, value_id, value):  #TODO: Add variable set  - delegate to Value obj - virtualize
         raise NotImplemented
         return None
+    
+    def get_set_command(self, value_id, value):
+        """
+        Returns the (method, message, params) tuple of the command setting the value
+        or None if the value can not be set. Used by the bulk write.
+        """
+        return None
     
\ No newline at end of file
@@ -0,0 +1,224 @@
+# Copyright (c) Klaudisz Staniek.
+# See LICENSE for details.
+
+"""
+Columnar value store implementation
+
+"""
+
+from array import array
+from threading import Lock
+from time import time, monotonic
+
+"numpy is optional. Required only for ValueStore.snapshot"
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+logger = logging.getLogger('manager')
+
+
+NaN = float('nan')
+
+
+class ValueStore(object):
+    """
+    Columnar storage of the driver values.
+    Values are kept in the parallel arrays indexed by row: ValueID handle, numeric value,
+    epoch and monotonic timestamps and units index (units strings are interned).
+    The value string is kept only if it can not be restored from the numeric value
+    i.e. non numeric values or numbers like "21.50".
+    Row attributes which differ from the defaults are kept in the sparse dictionary.
+    Removed rows have handle -1 and are reused. Rows are read and written under the lock,
+    so the reader never gets the columns of the reused row mixed.
+    """
+    def __init__(self):
+        self.handles = array('q')
+        self.numbers = array('d')
+        self.stamps = array('d')
+        self.monotonics = array('d')
+        self.units = array('l')
+        self.texts = []
+        self.contexts = {}      # data shared by the rows of the same kind (see ValueView)
+        self.__attributes = {}  # row -> { name: value }
+        self.__units_table = [ "" ]
+        self.__units_index = { "": 0 }
+        self.__free = []
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len( self.handles ) - len( self.__free )
+
+    def __intern_units(self, units):
+        if units is None:
+            units = ""
+        index = self.__units_index.get( units )
+        if index is None:
+            index = len( self.__units_table )
+            self.__units_table.append( units )
+            self.__units_index[units] = index
+        return index
+
+    @staticmethod
+    def __encode(value):
+        """
+        Returns the tuple of (number, text). Text is None if it can be restored from the number
+        """
+        text = str( value )
+        try:
+            number = float( text )
+        except ValueError:
+            return NaN, text
+        if ValueStore.__decode( number, None ) == text:
+            return number, None
+        return number, text
+
+    @staticmethod
+    def __decode(number, text):
+        if text is not None:
+            return text
+        if number.is_integer():
+            return str( int( number ) )
+        return repr( number )
+
+    def add(self, handle, value, units=None, stamp=None, monotonic_stamp=None):
+        """
+        Add the value and returns its row number
+
+        Params:
+            handle          :    ValueID handle
+            value           :    value
+            units           :    units string
+            stamp           :    epoch timestamp (now if None)
+            monotonic_stamp :    monotonic timestamp (now if None)
+        """
+        number, text = self.__encode( value )
+        stamp = time() if stamp is None else stamp
+        monotonic_stamp = monotonic() if monotonic_stamp is None else monotonic_stamp
+        with self.__lock:
+            units = self.__intern_units( units )
+            if self.__free:
+                row = self.__free.pop()
+                self.handles[row] = handle
+                self.numbers[row] = number
+                self.stamps[row] = stamp
+                self.monotonics[row] = monotonic_stamp
+                self.units[row] = units
+                self.texts[row] = text
+            else:
+                row = len( self.handles )
+                self.handles.append( handle )
+                self.numbers.append( number )
+                self.stamps.append( stamp )
+                self.monotonics.append( monotonic_stamp )
+                self.units.append( units )
+                self.texts.append( text )
+        return row
+
+    def remove(self, row):
+        with self.__lock:
+            self.handles[row] = -1
+            self.numbers[row] = NaN
+            self.texts[row] = None
+            self.__attributes.pop( row, None )
+            self.__free.append( row )
+
+    def get(self, row):
+        """
+        Returns the value string
+        """
+        with self.__lock:
+            number, text = self.numbers[row], self.texts[row]
+        return self.__decode( number, text )
+
+    def get_raw(self, row):
+        """
+        Returns the tuple of (number, text). Text is None if the value string is restored from the number
+        """
+        with self.__lock:
+            return self.numbers[row], self.texts[row]
+
+    def set(self, row, value, stamp=None, monotonic_stamp=None):
+        number, text = self.__encode( value )
+        stamp = time() if stamp is None else stamp
+        monotonic_stamp = monotonic() if monotonic_stamp is None else monotonic_stamp
+        with self.__lock:
+            self.numbers[row] = number
+            self.texts[row] = text
+            self.stamps[row] = stamp
+            self.monotonics[row] = monotonic_stamp
+
+    def get_units(self, row):
+        return self.__units_table[ self.units[row] ]
+
+    def set_units(self, row, units):
+        with self.__lock:
+            self.units[row] = self.__intern_units( units )
+
+    def get_stamp(self, row):
+        return self.stamps[row]
+
+    def get_monotonic(self, row):
+        return self.monotonics[row]
+
+    def set_stamp(self, row, stamp=None, monotonic_stamp=None):
+        stamp = time() if stamp is None else stamp
+        monotonic_stamp = monotonic() if monotonic_stamp is None else monotonic_stamp
+        with self.__lock:
+            self.stamps[row] = stamp
+            self.monotonics[row] = monotonic_stamp
+
+    def get_attribute(self, row, name, default=None):
+        attributes = self.__attributes.get( row )
+        if attributes is None:
+            return default
+        return attributes.get( name, default )
+
+    def set_attribute(self, row, name, value):
+        """
+        Set the row attribute, None removes it
+        """
+        with self.__lock:
+            attributes = self.__attributes.get( row )
+            if value is None:
+                if attributes is not None:
+                    attributes.pop( name, None )
+                    if not attributes:
+                        del self.__attributes[row]
+            elif attributes is None:
+                self.__attributes[row] = { name: value }
+            else:
+                attributes[name] = value
+
+    def get_attributes(self, row):
+        """
+        Returns the dictionary of the row attributes
+        """
+        with self.__lock:
+            return dict( self.__attributes.get( row, {} ) )
+
+    def snapshot(self):
+        """
+        Returns the dictionary of NumPy arrays with all the values:
+            handle      :    ValueID handles (int64)
+            value       :    numeric values, NaN if value is not a number (float64)
+            timestamp   :    epoch timestamps (float64)
+            units       :    units strings
+        """
+        if numpy is None:
+            raise ImportError("numpy required for ValueStore.snapshot")
+
+        with self.__lock:
+            handles = numpy.array( self.handles, dtype=numpy.int64 )
+            numbers = numpy.array( self.numbers, dtype=numpy.float64 )
+            stamps = numpy.array( self.stamps, dtype=numpy.float64 )
+            units = numpy.array( self.units, dtype=numpy.int64 )
+            units_table = numpy.array( self.__units_table )
+
+        live = handles >= 0
+        return dict( handle = handles[live],
+                     value = numbers[live],
+                     timestamp = stamps[live],
+                     units = units_table[ units[live] ] )
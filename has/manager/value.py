@@ -8,8 +8,12 @@ Value and ValueID class implementation
 
 #from  manager.manager import Manager
 from datetime import datetime
-from time import time
+from time import time, monotonic
+import weakref
+from threading import Lock
 from has.utils.notification import Notification
+from has.manager.history import ValueHistory
+from has.manager.store import ValueStore
 from has.utils.utils import *
 
 import logging
@@ -18,27 +22,80 @@ logger = logging.getLogger('manager')
 
 
 class ValueID(object):
+    """
+    Unique value identifier.
+    Instances are interned: the same object is returned for the same network_id, node_id
+    and value_type, so the components, string and hash are computed only once.
+    Each instance gets the small integer handle accepted by Manager instead of ValueID.
+    """
+    __slots__ = ( '__id', '__network_id', '__node_id', '__value_type', '__hash', '__handle' )
     
-    def __init__(self, network_id, node_id, value_type):
-        self.__id = ':'.join( ( str(network_id), str(node_id), str(value_type) ) )
+    __registry = {}     # (network_id, node_id, value_type) -> ValueID
+    __handles = []      # handle -> ValueID
+    __lock = Lock()
+    
+    def __new__(cls, network_id, node_id, value_type):
+        key = ( str(network_id), str(node_id), str(value_type) )
+        value_id = cls.__registry.get( key )
+        if value_id is not None:
+            return value_id
+        
+        with cls.__lock:
+            value_id = cls.__registry.get( key )
+            if value_id is None:
+                value_id = object.__new__(cls)
+                value_id.__network_id, value_id.__node_id, value_id.__value_type = key
+                value_id.__id = ':'.join( key )
+                value_id.__hash = hash( value_id.__id )
+                value_id.__handle = len( cls.__handles )
+                cls.__handles.append( value_id )
+                cls.__registry[key] = value_id
+        return value_id
+    
+    @classmethod
+    def from_handle(cls, handle):
+        """
+        Returns the ValueID for the integer handle or None if not exists
+        """
+        if isinstance( handle, bool ) or handle < 0:
+            return None
+        try:
+            return cls.__handles[handle]
+        except IndexError:
+            return None
+    
+    @classmethod
+    def resolve(cls, value_id):
+        """
+        Returns the ValueID for ValueID or integer handle (None for the unknown or negative handle)
+        """
+        if isinstance( value_id, int ):
+            return cls.from_handle( value_id )
+        return value_id
+    
+    @property
+    def handle(self):
+        return self.__handle
     
     @property
-    def    id(self):
+    def id(self):
         return self.__id
     
     @property    
     def network_id(self):
-        return self.__id.split(':')[0]
+        return self.__network_id
     
     @property
     def node_id(self):
-        return self.__id.split(':')[1]
+        return self.__node_id
     
     @property    
     def value_type(self):
-        return self.__id.split(':')[2]
+        return self.__value_type
         
     def __eq__(self, other):
+        if self is other:
+            return True
         if isinstance(other, ValueID):
             return self.__id == other.__id
         return NotImplemented
@@ -50,35 +107,310 @@ class ValueID(object):
         return not result
         
     def __str__(self):
-        return str(self.__id)
+        return self.__id
+    
+    def __repr__(self):
+        return "ValueID({0})".format( self.__id )
         
     def __hash__(self):
-        return hash(str(self))    
+        return self.__hash
+    
+    def __reduce__(self):
+        return ( ValueID, ( self.__network_id, self.__node_id, self.__value_type ) )
         
     def __iter__(self):
         yield self.__id
     
+class ValueCodec(object):
+    """
+    Conversion between the value string received from the controller and the native value.
+    The base codec keeps the value as the string.
+    """
+    name = "text"
+    
+    def decode(self, value):
+        """
+        Returns the native value. Values already native are returned as they are.
+        """
+        return value if isinstance( value, str ) else str( value )
+    
+    def encode(self, value):
+        """
+        Returns the value string
+        """
+        return value if isinstance( value, str ) else str( value )
+    
+    def from_number(self, number):
+        """
+        Returns the native value of the number column of the ValueStore.
+        The store keeps only the numbers which restore the value string exactly (see number_text).
+        """
+        return number_text( number )
+
+
+class NumberCodec(ValueCodec):
+    """
+    Integer or float number. Strings which are not numbers are kept as strings.
+    """
+    name = "number"
+    
+    def decode(self, value):
+        if isinstance( value, ( int, float ) ) and not isinstance( value, bool ):
+            return value
+        value = str( value )
+        try:
+            return int( value )
+        except ValueError:
+            pass
+        try:
+            number = float( value )
+        except ValueError:
+            return value
+        return number if number == number else value   # NaN kept as string
+    
+    def from_number(self, number):
+        if number.is_integer():
+            return int( number )
+        return number if number == number else number_text( number )
+    
+
+class EpochCodec(NumberCodec):
+    """
+    Epoch timestamp in seconds
+    """
+    name = "epoch"
+    
+    def decode(self, value):
+        if isinstance( value, int ) and not isinstance( value, bool ):
+            return value
+        value = str( value )
+        try:
+            return int( value )
+        except ValueError:
+            return value
+    
+    def from_number(self, number):
+        return int( number ) if number.is_integer() else number_text( number )
+
+
+class BoolCodec(ValueCodec):
+    """
+    Boolean flag sent as "0" or "1". Other strings are kept as strings.
+    """
+    name = "bool"
+    
+    def decode(self, value):
+        if isinstance( value, bool ):
+            return value
+        value = str( value )
+        if value == "1":
+            return True
+        if value == "0":
+            return False
+        return value
+    
+    def encode(self, value):
+        if isinstance( value, bool ):
+            return "1" if value else "0"
+        return str( value )
+    
+    def from_number(self, number):
+        if number == 1:
+            return True
+        if number == 0:
+            return False
+        return number_text( number )
+
+
+def number_text(number):
+    """
+    Returns the canonical string of the float number ("21" for 21.0, "21.5" for 21.5)
+    """
+    return str( int( number ) ) if number.is_integer() else repr( number )
+
+
+text_codec = ValueCodec()
+number_codec = NumberCodec()
+epoch_codec = EpochCodec()
+bool_codec = BoolCodec()
+
+
+class BaseValue(object):
+    """
+    Node value behaviour shared by Value and ValueView.
+    The subclass keeps the value data and the attributes: value_id, codec, driver, history,
+    label, location, is_read_only, get, _value, _assign, units and the last_changed timestamps.
+    """
+    __slots__ = ()
+    
+    def enable_history(self, depth, window):
+        """
+        Keep the history of the value changes (see ValueHistory)
+        
+        Params:
+            depth   :    maximum number of the changes kept
+            window  :    statistics window in seconds
+        """
+        history = ValueHistory( depth, window )
+        history.add( self.last_changed_epoch, self.last_changed_monotonic, self._value )
+        self._set_history( history )
+    
+    def bind_store(self, store):
+        """
+        Returns the ValueView keeping the value data in the ValueStore
+        """
+        return self
+    
+    def unbind_store(self):
+        """
+        Release the ValueStore row
+        """
+        return
+    
+    @property
+    def network_id(self):
+        return self.value_id.network_id
+
+    @property    
+    def value_type(self):
+        return self.value_id.value_type
+    
+    def get_typed(self):
+        """ Returns the native value (bool, int, float or str depending on the codec) """
+        return self._value
+    
+    def render(self):
+        return "{0}{1}".format(self.get(), self.units)
+
+        
+    def set(self, value):
+        if( self.is_read_only ):
+            logger.debug("Value:set ValueType:%s is read only" % self.value_type)
+            return False
+        
+        driver = self.driver
+        if driver is not None:
+            node = driver.get_node_unsafe( self.value_id.node_id )
+            if node is not None:
+                node.set_value( self, value )
+                return True
+
+        return False
+    
+    def on_value_refresh(self, value):
+        """
+        Update the value if the typed value changed. If only the formatting of the
+        controller string changed (i.e. "21.50" -> "21.5") the string is replaced silently:
+        no timestamp, notification, history or change log entry.
+        """
+        codec = self.codec
+        text = codec.encode( value )
+        if text == self.get():
+            return
+        typed = codec.decode( value )
+        current = self._value
+        if typed == current and isinstance( typed, bool ) == isinstance( current, bool ):   # True == 1
+            self._replace( typed, text )
+        else:
+            self.update(value)
+            
+    def update(self, value):
+        codec = self.codec
+        text = codec.encode( value )
+        value = codec.decode( value )
+        old_text = self.get()
+        self._assign( value, text )
+        epoch, stamp = self.last_changed_epoch, self.last_changed_monotonic
+        history = self.history
+        if history is not None:
+            history.add( epoch, stamp, value )
+        value_id = self.value_id
+        # stamped by _assign, shared with the notification
+        notification = Notification( Notification.Type_ValueChanged, value_id.network_id, value_id.node_id,
+                                     value_id = value_id, old_value = old_text, new_value = text,
+                                     timestamp = stamp, epoch = epoch )
+        driver = self.driver
+        if driver is not None:
+            driver.queue_notification( notification )
+            changelog = driver.changelog
+            if changelog is not None and not isinstance( value, str ):   # only numbers are logged
+                changelog.append( value_id, epoch, stamp, value )
+
+
 @timestamp('last_changed', ('set','update'))
-class Value(object):
-    def __init__(self, network_id, node_id, value_type, value, units = None):
+class Value(BaseValue):
+    """
+    Node value. The value is kept in its native type (see ValueCodec), the codec is chosen
+    when the value is created. The string received from the controller is kept next to it,
+    so get and the notifications return it unchanged and only get_typed returns the native value.
+    The string rendering (get_as_string) is cached until the next update.
+    When the driver keeps the values in the ValueStore the value is replaced with the ValueView (see bind_store).
+    """
+    __slots__ = ( '__id', '__value', '__units', '__label', '__read_only', '__location',
+                  '__last_changed', '__last_changed_monotonic',    # epoch and monotonic, see timestamp decorator
+                  '_driver', '_history', '_codec', '_string', '_text' )
+    
+    def __init__(self, network_id, node_id, value_type, value, units = None, codec = text_codec):
         
-        self._value_type = value_type
-        self._value = str(value)
+        self.__id = ValueID( network_id, node_id, value_type )
+        self._codec = codec
+        self._string = None
+        self._text = codec.encode( value )   # controller string, returned by get
+        self.__value = codec.decode( value )
         self.__units = units
-        self.__network_id = network_id
-        self.__node_id = node_id
         self.__label = ""
         self.__read_only = True
-        self.__id = ValueID( network_id, node_id, value_type )
+        self.__location = None
+        self.__last_changed = time()
+        self.__last_changed_monotonic = monotonic()
+        self._driver = None
+        self._history = None
+    
+    def bind_driver(self, driver):
+        """
+        Keep the weak reference to the driver owning the value
+        """
+        self._driver = weakref.ref( driver ) if driver is not None else None
+    
+    @property
+    def driver(self):
+        return self._driver() if self._driver is not None else None
+    
+    @property
+    def history(self):
+        """ ValueHistory or None if history is not enabled """
+        return self._history
+    
+    def _set_history(self, history):
+        self._history = history
+    
+    def bind_store(self, store):
+        """
+        Move the value data to the ValueStore. Returns the ValueView replacing this value
+        """
+        return ValueView.of( type( self ) )( self, store )
+    
+    @property
+    def _value(self):
+        """ Native value """
+        return self.__value
+    
+    def _assign(self, value, text):
+        """ Set the native value and the controller string """
+        self.__value = value
+        self._text = text
+        self._string = None
+    
+    def _replace(self, value, text):
+        """ Replace the equal native value and its controller string, not stamped """
+        self.__value = value
+        self._text = text
+        self._string = None
         
     @property
     def value_id(self):
         return self.__id
     
-    @property
-    def network_id(self):
-        return self.__network_id
-    
     @property
     def is_read_only(self):
         return self.__read_only
@@ -94,10 +426,6 @@ class Value(object):
     @label.setter
     def label(self, value):
         self.__label = value
-
-    @property    
-    def value_type(self):
-        return self._value_type
     
     @property    
     def location(self):
@@ -114,68 +442,212 @@ class Value(object):
     @units.setter
     def units(self, value):
         self.__units = value
+        self._string = None
     
-    #@property
-    #def timestamp(self):
-        return self.__last_changed
-    
-    #@timestamp.setter
-    #def timestamp(self, value = None):
-    #    if value is None:
-    #        self.__last_changed = datetime.today()
-    #    else:
-    #        if isinstance(value,int):
-    #            value = datetime.fromtimestamp(value)
-    #        self.__last_changed = value
+    @property
+    def codec(self):
+        return self._codec
             
     def get(self):
-        #from  has.manager.manager import Manager  # to avoid import loop
-        #driver = Manager.get_driver( self.__network_id )
-        #node = driver.get_node_unsafe( self.__node_id )
-        #node.query_node_info()
-        return str(self._value)
+        """ Returns the value string as received from the controller """
+        return self._text
         
     def get_as_string(self):
-        from  has.manager.manager import Manager  # to avoid import loop
-        driver = Manager.get_driver( self.__network_id )
-        node = driver.get_node_unsafe( self.__node_id )
-        result = "{0}{1}".format(self._value, self.__units)
+        """ Returns the human readable value. Cached until the next update """
+        result = self._string
+        if result is None:
+            result = self._string = self.render()
         return result
 
-        
-    def set(self, value):
-        if( self.is_read_only ):
-            logger.debug("Value:set ValueType:%s is read only" % self.value_type)
-            return False
-        
-        from has.manager.manager import Manager
-        driver = Manager.get_driver( self.__network_id ) 
-        if driver is not None:
-            node = driver.get_node_unsafe( self.__node_id )
-            if node is not None:
-                node.set_value( self, value )
-                return True
 
-        return False
+class ValueViewContext(object):
+    """
+    Data shared by the views of the same ValueStore and codec
+    """
+    __slots__ = ( 'store', 'codec', 'driver' )
     
-    def on_value_refresh(self, value):
-        if self._value != value:
-            self.update(value)
-            
-    def update(self, value):
-        self._value = str(value)
-        notification = Notification( Notification.Type_ValueChanged )
-        notification.node_id = self.__node_id
-        notification.network_id = self.__network_id
-        notification.value_id = self.__id
-        from has.manager.manager import Manager
-        driver = Manager.get_driver( self.__network_id )
-        driver.queue_notification( notification )
-        
+    def __init__(self, store, codec, driver):
+        self.store = store
+        self.codec = codec
+        self.driver = driver    # weak reference or None
+    
+    @classmethod
+    def of(cls, store, codec, driver):
+        """
+        Returns the context kept by the store for the codec
+        """
+        context = store.contexts.get( codec )
+        if context is None:
+            context = store.contexts[codec] = cls( store, codec, driver )
+        return context
+
+
+class ValueView(BaseValue):
+    """
+    Value kept in the driver ValueStore. The object is the row number and the context shared
+    by the values of the same store and codec. The ValueID is restored from the handle column,
+    the value string, units and both timestamps are kept in the store columns and
+    the attributes which differ from the defaults (read only, label, location, history)
+    in the store row attributes. get_as_string is not cached.
+    Values of the Value subclasses get the view subclass with their methods (see of).
+    """
+    __slots__ = ( '_context', '_row' )
+    __classes = {}   # Value subclass -> ValueView subclass
+    
+    def __init__(self, value, store):
+        """
+        Params:
+            value   :    Value moved to the store
+            store   :    ValueStore
+        """
+        self._context = ValueViewContext.of( store, value.codec, value._driver )
+        self._row = store.add( value.value_id.handle, value.get(), value.units,
+                               value.last_changed_epoch, value.last_changed_monotonic )
+        self.is_read_only = value.is_read_only
+        self.label = value.label
+        self.location = value.location
+        self._set_history( value.history )
+    
+    @classmethod
+    def of(cls, value_class):
+        """
+        Returns the ValueView class for the Value class
+        """
+        if value_class is Value:
+            return cls
+        view_class = cls.__classes.get( value_class )
+        if view_class is None:
+            namespace = { '__slots__': () }
+            for klass in reversed( value_class.__mro__[ : value_class.__mro__.index( Value ) ] ):
+                namespace.update( ( name, attr ) for name, attr in vars( klass ).items() if not name.startswith( '__' ) )
+            view_class = cls.__classes[value_class] = type( value_class.__name__ + "View", ( cls, ), namespace )
+        return view_class
+    
+    def unbind_store(self):
+        """
+        Release the store row. The value data is moved to the single row store,
+        so the view still returns the last value if referenced after the removal
+        """
+        context, row = self._context, self._row
+        store = context.store
+        detached = ValueStore()
+        self._context = ValueViewContext.of( detached, context.codec, context.driver )
+        self._row = detached.add( store.handles[row], store.get( row ), store.get_units( row ),
+                                  store.get_stamp( row ), store.get_monotonic( row ) )
+        for name, value in store.get_attributes( row ).items():
+            detached.set_attribute( self._row, name, value )
+        store.remove( row )
+    
+    def __attribute(self, name, default):
+        return self._context.store.get_attribute( self._row, name, default )
+    
+    def __set_attribute(self, name, value, default):
+        self._context.store.set_attribute( self._row, name, value if value != default else None )
+    
+    @property
+    def value_id(self):
+        return ValueID.from_handle( self._context.store.handles[ self._row ] )
+    
+    @property
+    def codec(self):
+        return self._context.codec
+    
+    @property
+    def driver(self):
+        driver = self._context.driver
+        return driver() if driver is not None else None
+    
+    @property
+    def history(self):
+        """ ValueHistory or None if history is not enabled """
+        return self.__attribute( 'history', None )
+    
+    def _set_history(self, history):
+        self.__set_attribute( 'history', history, None )
+    
+    @property
+    def is_read_only(self):
+        return self.__attribute( 'read_only', True )
         
+    @is_read_only.setter
+    def is_read_only(self, value):
+        self.__set_attribute( 'read_only', value, True )
+    
+    @property 
+    def label(self):
+        return self.__attribute( 'label', "" )
+    
+    @label.setter
+    def label(self, value):
+        self.__set_attribute( 'label', value, "" )
+    
+    @property    
+    def location(self):
+        return self.__attribute( 'location', None )
+    
+    @location.setter
+    def location(self, value):
+        self.__set_attribute( 'location', value, None )
+    
+    @property
+    def _value(self):
+        """ Native value, from the number column if the store keeps the number only """
+        number, text = self._context.store.get_raw( self._row )
+        if text is None:
+            return self._context.codec.from_number( number )
+        return self._context.codec.decode( text )
+    
+    def _assign(self, value, text):
+        """ Set the controller string and stamp the row """
+        self._context.store.set( self._row, text )
+    
+    def _replace(self, value, text):
+        """ Replace the equal native value and its controller string, the row stamps are kept """
+        store, row = self._context.store, self._row
+        store.set( row, text, store.get_stamp( row ), store.get_monotonic( row ) )
+    
+    @property
+    def units(self):
+        return self._context.store.get_units( self._row )
+    
+    @units.setter
+    def units(self, value):
+        self._context.store.set_units( self._row, value )
+    
+    def get(self):
+        """ Returns the value string as received from the controller """
+        return self._context.store.get( self._row )
     
-class TimeStampValue(Value):
     def get_as_string(self):
+        """ Returns the human readable value """
+        return self.render()
+    
+    def set(self, value):
+        self._context.store.set_stamp( self._row )
+        return super().set( value )
+    
+    @property
+    def last_changed(self):
+        return datetime.fromtimestamp( self._context.store.get_stamp( self._row ) )
+    
+    @last_changed.setter
+    def last_changed(self, value):
+        epoch = to_epoch( value )
+        self._context.store.set_stamp( self._row, epoch, monotonic() - ( time() - epoch ) )
+    
+    @property
+    def last_changed_epoch(self):
+        return self._context.store.get_stamp( self._row )
+    
+    @property
+    def last_changed_monotonic(self):
+        return self._context.store.get_monotonic( self._row )
+    
+    
+class TimeStampValue(Value):
+    __slots__ = ()
+    
+    def render(self):
         try:
             timestamp = int(self._value)
             result = datetime.fromtimestamp(timestamp)
@@ -183,12 +655,33 @@ class TimeStampValue(Value):
             result = "unknown"
         return result
         
+def flag_state(value):
+    """
+    Returns True/False for the typed flag value (bool or number 1/other) or None if it is not a flag
+    """
+    if isinstance( value, bool ):
+        return value
+    try:
+        return float( value ) == 1
+    except ( TypeError, ValueError ):
+        return None
+
 class OpenCloseValue(Value):
-    def get_as_string(self):
-        return "open" if int(self._value) == 1 else "close"
+    __slots__ = ()
+    
+    def render(self):
+        state = flag_state( self._value )
+        if state is None:
+            return self.get()
+        return "open" if state else "close"
 
 class OnOffValue(Value):
-    def get_as_string(self):
-        return "on" if int(self._value) == 1 else "off"
+    __slots__ = ()
+    
+    def render(self):
+        state = flag_state( self._value )
+        if state is None:
+            return self.get()
+        return "on" if state else "off"
 
     
\ No newline at end of file
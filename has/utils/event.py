@@ -6,7 +6,8 @@ This is a implementation of Watcher, Wait and Event classes required for multith
 
 """
 
-from threading import Lock, Condition
+from threading import Lock, Condition, local, get_ident
+from time import monotonic
 import logging
 logger = logging.getLogger('manager')
 
@@ -92,6 +93,8 @@ class Wait(object):
         """
         Notify watchers
         """
+        if not self.watchers:   # nothing is waiting - skip the lock
+            return
         with self.lock:
             for watcher in self.watchers:
                 watcher()    # Watcher is callable
@@ -140,6 +143,85 @@ class Wait(object):
         objects = [single_object]
         return Wait.multiple(objects, 1 , timeout)
 
+
+class WaitSet(object):
+    """
+    Persistent multiplexed wait for the set of Event objects.
+    Unlike Wait.multiple the watchers are registered once (armed) and stay
+    registered until close() is called, so waiting in a loop does not
+    allocate nor register/unregister anything.
+    """
+    def __init__(self, objects, num_objects=None, name="WaitSet"):
+        """
+        Params:
+            objects        :    list or dictionary (indexed from 0) of objects derived from Event class
+            num_objects    :    number of objects in dictionary
+            name           :    name of the internal Event object
+        """
+        if num_objects == None:
+            num_objects = len(objects)
+        
+        self.__objects = tuple( objects[i] for i in range( num_objects ) )
+        self.__event = Event(name)
+        self.__armed = False
+        self.arm()
+    
+    def __repr__(self):
+        return "WaitSet: %s" % (self.__objects,)
+    
+    def arm(self):
+        """
+        Register the watchers in all the objects
+        """
+        if not self.__armed:
+            for obj in self.__objects:
+                obj.add_watcher( wait_multiple_callback, self.__event )
+            self.__armed = True
+    
+    def close(self):
+        """
+        Unregister the watchers from all the objects
+        """
+        if self.__armed:
+            for obj in self.__objects:
+                obj.remove_watcher( wait_multiple_callback, self.__event )
+            self.__armed = False
+    
+    def ready(self):
+        """
+        Returns the list of indexes of signaled objects (lower index first)
+        """
+        return [ i for i, obj in enumerate( self.__objects ) if obj.is_set() ]
+    
+    def wait(self, timeout=None):
+        """
+        Wait until at least one of the objects is signaled
+        
+        Params:
+            timeout    :    timeout - None means forever
+        
+        Returns the list of indexes of signaled objects (lower index first).
+        Empty list is returned on timeout.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            # clear before polling the objects, so the signal set in between is not lost
+            self.__event.clear()
+            ready = self.ready()
+            if ready:
+                break
+            
+            if deadline is not None:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+            
+            if not self.__event.wait( timeout ):
+                break
+        
+        logger.debug("WaitSet.wait: Signaled: %s" % ready )
+        return ready
+
 class Event(Wait):
     def __init__(self, name):
         self.__flag = False
@@ -161,7 +243,8 @@ class Event(Wait):
         finally:
             self.__cond.release()
         
-        self.notify()
+        if self.watchers:
+            self.notify()
         
     def clear(self):
         self.__cond.acquire()
@@ -179,4 +262,125 @@ class Event(Wait):
             return signaled
         finally:
             self.__cond.release()    
-        
\ No newline at end of file
+        
+
+class RWLock(object):
+    """
+    Readers-writer lock.
+    Many readers can hold the lock at the same time, the writer holds it exclusively.
+    Waiting writer blocks the new readers, so the readers can not starve the writer.
+    The lock is reentrant for the writer thread (also when it acquires the read lock)
+    and for the reader thread: nested reads do not wait for the waiting writer.
+    acquire/release and the context manager take the write lock.
+    
+    Wait and hold times are measured and available from get_stats().
+    """
+    def __init__(self):
+        self.__cond = Condition(Lock())
+        self.__readers = 0
+        self.__writers_waiting = 0
+        self.__owner = None
+        self.__depth = 0
+        self.__local = local()
+        self.__stats_lock = Lock()
+        self.reset_stats()
+    
+    def reset_stats(self):
+        with self.__stats_lock:
+            self.__stats = dict( read_count = 0, read_wait = 0.0, read_hold = 0.0, read_hold_max = 0.0,
+                                 write_count = 0, write_wait = 0.0, write_hold = 0.0, write_hold_max = 0.0,
+                                 readers_max = 0 )
+    
+    def get_stats(self):
+        """
+        Returns the dictionary with lock statistics (times in seconds):
+            read_count, read_wait, read_hold, read_hold_max,
+            write_count, write_wait, write_hold, write_hold_max, readers_max
+        """
+        with self.__stats_lock:
+            return dict( self.__stats )
+    
+    def __account(self, kind, wait, hold, readers=0):
+        with self.__stats_lock:
+            stats = self.__stats
+            stats[kind + '_count'] += 1
+            stats[kind + '_wait'] += wait
+            stats[kind + '_hold'] += hold
+            if hold > stats[kind + '_hold_max']:
+                stats[kind + '_hold_max'] = hold
+            if readers > stats['readers_max']:
+                stats['readers_max'] = readers
+    
+    def __stack(self):
+        try:
+            return self.__local.stack
+        except AttributeError:
+            self.__local.stack = []
+            return self.__local.stack
+    
+    def acquire_read(self):
+        if self.__owner == get_ident():   # writer reads
+            self.__depth += 1
+            return True
+        stack = self.__stack()
+        if stack:   # nested read, the thread already holds the read lock
+            stack.append( None )
+            return True
+        start = monotonic()
+        with self.__cond:
+            while self.__owner is not None or self.__writers_waiting:
+                self.__cond.wait()
+            self.__readers += 1
+            readers = self.__readers
+        stack.append( ( start, monotonic(), readers ) )
+        return True
+    
+    def release_read(self):
+        if self.__owner == get_ident():
+            self.__depth -= 1
+            return
+        entry = self.__stack().pop()
+        if entry is None:
+            return
+        start, acquired, readers = entry
+        with self.__cond:
+            self.__readers -= 1
+            if self.__readers == 0:
+                self.__cond.notify_all()
+        self.__account( 'read', acquired - start, monotonic() - acquired, readers )
+    
+    def acquire(self):
+        me = get_ident()
+        if self.__owner == me:
+            self.__depth += 1
+            return True
+        start = monotonic()
+        with self.__cond:
+            self.__writers_waiting += 1
+            while self.__owner is not None or self.__readers:
+                self.__cond.wait()
+            self.__writers_waiting -= 1
+            self.__owner = me
+            self.__depth = 1
+        self.__write_wait = monotonic() - start
+        self.__write_acquired = monotonic()
+        return True
+    
+    def release(self):
+        if self.__owner != get_ident():
+            raise RuntimeError("RWLock.release: lock not owned")
+        self.__depth -= 1
+        if self.__depth:
+            return
+        wait, hold = self.__write_wait, monotonic() - self.__write_acquired
+        with self.__cond:
+            self.__owner = None
+            self.__cond.notify_all()
+        self.__account( 'write', wait, hold )
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *args):
+        self.release()
@@ -5,62 +5,66 @@
 General purpose Notification class
 
 """
+from itertools import count
+from time import monotonic, time
 
 
-class Notification:
+_sequence = count(1)
+
+
+class Notification(object):
+	"""
+	Immutable notification.
+	Each notification gets the sequence number, the monotonic timestamp and the epoch time when created.
+	Value notifications carry the old and the new value, so watchers do not need to read it back.
+	"""
 	Type_DriverReady, \
 	Type_DriverFailed, \
 	Type_DriverReset, \
 	Type_NodeAdded, \
 	Type_NodeRemoved, \
-    Type_NodeChanged, \
+	Type_NodeChanged, \
 	Type_ValueAdded, \
 	Type_ValueRemoved, \
 	Type_ValueChanged, \
 	Type_NodeQueriesComplete, \
-	Type_AllNodesQueried = range(11)
-	
-	def __init__(self, notification_type):
-		self.__notification_type = notification_type
-		self.__node_id = None
-		self.__network_id = None
-		self.__device_rype = None
-		self.__value_id = None
-	
-	@property	
-	def type(self):
-		return self.__notification_type
-		
-	@property
-	def node_id(self):
-		""" Unique Node ID """
-		return self.__node_id
-	
-	@node_id.setter
-	def node_id(self, value):
-		self.__node_id = value
-	
-	@property
-	def node_type(self):
-		return self.__node_type
+	Type_AllNodesQueried, \
+	Type_DriverCacheLoaded = range(12)
 	
-	@node_type.setter
-	def node_type(self, value):
-		self.__node_type = value
+	__slots__ = ( 'type', 'network_id', 'node_id', 'node_type', 'value_id', 'old_value', 'new_value', 'timestamp', 'epoch', 'sequence' )
 	
-	@property
-	def network_id(self):
-		return self.__network_id
+	def __init__(self, notification_type, network_id=None, node_id=None, node_type=None, value_id=None, 
+				old_value=None, new_value=None, timestamp=None, epoch=None):
+		"""
+		Params:
+			notification_type	: one of Notification.Type_*
+			network_id			: network id
+			node_id				: unique node id
+			node_type			: node type
+			value_id			: ValueID object
+			old_value			: value before the change
+			new_value			: value after the change
+			timestamp			: monotonic time of the event (now if None)
+			epoch				: wall clock time of the event (now if None)
+		"""
+		setter = object.__setattr__
+		setter(self, 'type', notification_type)
+		setter(self, 'network_id', network_id)
+		setter(self, 'node_id', node_id)
+		setter(self, 'node_type', node_type)
+		setter(self, 'value_id', value_id)
+		setter(self, 'old_value', old_value)
+		setter(self, 'new_value', new_value)
+		setter(self, 'timestamp', monotonic() if timestamp is None else timestamp)
+		setter(self, 'epoch', time() if epoch is None else epoch)
+		setter(self, 'sequence', next(_sequence))
 	
-	@network_id.setter
-	def network_id(self, value):
-		self.__network_id = value
+	def __setattr__(self, name, value):
+		raise AttributeError("Notification is immutable")
 	
-	@property
-	def value_id(self):
-		return self.__value_id
+	def __delattr__(self, name):
+		raise AttributeError("Notification is immutable")
 	
-	@value_id.setter
-	def value_id(self, value):
-		self.__value_id = value
-	
\ No newline at end of file
+	def __repr__(self):
+		return "Notification(type={0}, network_id={1}, node_id={2}, value_id={3}, seq={4})".format(
+				self.type, self.network_id, self.node_id, self.value_id, self.sequence)
@@ -11,8 +11,10 @@ from datetime import datetime, timezone
 "dateutil required for conversion timestamp from iso string"
 from dateutil import parser
 import time
+from time import monotonic
+from types import MemberDescriptorType
 
-__all__ = ["timestamp", "delegate", "GenericDescriptor", "EPOCH"]
+__all__ = ["timestamp", "delegate", "GenericDescriptor", "EPOCH", "to_epoch"]
 
 EPOCH = datetime(1970, 1, 1) #, tzinfo=timezone.utc)
 
@@ -33,12 +35,31 @@ class GenericDescriptor:  # refer to page 423 form book
 		if self.setter is None:
 			raise ValueError("Trying to alter readonly attribute")
 		return self.setter(instance, value)
+
+def to_epoch(value):
+	"""
+	Returns the float epoch of the iso string, epoch number or datetime instance
+	"""
+	if isinstance(value, str): #assume valid datetime string
+		"update from iso string"
+		return parser.parse(value).timestamp()
+	elif isinstance(value, (int, float)):
+		"update from epoch"
+		return float(value)
+	elif isinstance(value, datetime):
+		"update from datetime instance"
+		return value.timestamp()
+	raise NotImplementedError
+
 """ 
 Decorators
 """
 def timestamp(attribute, method_names):
 	"""
-	Decorate methods passed as parameters with timestamp feature
+	Decorate methods passed as parameters with timestamp feature.
+	The timestamp is kept as the float epoch in the private attribute __<attribute> and the monotonic
+	time in __<attribute>_monotonic. The <attribute> property converts it to datetime on demand,
+	<attribute>_epoch and <attribute>_monotonic properties return the raw values.
 	
 	params:
 		attribute		: name of the attribute used as timestamp
@@ -50,13 +71,19 @@ def timestamp(attribute, method_names):
 		
 		def touch(function):
 			def wrapper(self, *args, **kwargs):
-				self.__setattr__(attribute_name, datetime.today())
+				setter(self, attribute_name, time.time())
+				setter(self, monotonic_name, monotonic())
 				return function(self, *args, **kwargs)
 			return wrapper
+		setter = object.__setattr__
 		nonlocal attribute
 		if not attribute.startswith("__"):
 			attribute_name = "_" + cls.__name__ + "__" + attribute
-			setattr(cls,attribute_name, datetime.today()) #set to localtime timestamp
+			monotonic_name = attribute_name + "_monotonic"
+			if not isinstance(getattr(cls, attribute_name, None), MemberDescriptorType):
+				setattr(cls, attribute_name, time.time()) #set to epoch timestamp
+				setattr(cls, monotonic_name, monotonic())
+			# else: attributes declared in __slots__ must be initialized by the instance
 		else:
 			raise ValueError("Private attribute used: {0}".format(attribute))
 		
@@ -68,26 +95,16 @@ def timestamp(attribute, method_names):
 		needed in the future
 		"""				
 		def __last_changed_getter(self):
-			return getattr(self, attribute_name)
+			return datetime.fromtimestamp(getattr(self, attribute_name))
 		
 		def __last_changed_setter(self, value):
-			if isinstance(value, str): #assume valid datetime string
-				"update from iso string"
-				setattr(self, attribute_name, parser.parse(value))
-				#raise NotImplementedError("dateutil must be used to import from iso")
-
-			elif isinstance(value, int):
-				"update from epoch"
-				setattr(self, attribute_name, datetime.fromtimestamp(value))
-
-			elif isinstance(value, datetime):
-				"update from datetime instance"
-				setattr(self, attribute_name, value)	
-				#print(type(value))
-			else:
-				raise NotImplementedError
+			epoch = to_epoch(value)
+			setter(self, attribute_name, epoch)
+			setter(self, monotonic_name, monotonic() - (time.time() - epoch))
 				
 		setattr(cls, attribute, GenericDescriptor(__last_changed_getter, __last_changed_setter))
+		setattr(cls, attribute + "_epoch", GenericDescriptor(lambda self: getattr(self, attribute_name)))
+		setattr(cls, attribute + "_monotonic", GenericDescriptor(lambda self: getattr(self, monotonic_name)))
 		return cls
 	return decorator
 			